@@ -37,10 +37,11 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'app'
+    'app.apps.AppConfig'
 ]
 
 MIDDLEWARE = [
+    'app.middlewares.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -56,7 +57,7 @@ ROOT_URLCONF = 'Recreatus.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'app.profiling.ProfilingDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')]
         ,
         'APP_DIRS': True,
@@ -76,14 +77,63 @@ WSGI_APPLICATION = 'Recreatus.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
+# RECREATUS_DATABASE selects development (default) or production. Production keeps
+# connections open for CONN_MAX_AGE seconds and runs PRAGMAS on every new connection,
+# WAL lets readers work while a write is in progress, busy_timeout and immediate
+# transactions make writers wait for the lock instead of failing with "database is locked"
 
-DATABASES = {
-    'default': {
+DATABASE_PROFILES = {
+    'development': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+    },
+    'production': {
+        'ENGINE': 'app.backends.sqlite3',
+        'NAME': os.environ.get('RECREATUS_DATABASE_PATH', os.path.join(BASE_DIR, 'db.sqlite3')),
+        'CONN_MAX_AGE': 600,
+        'TRANSACTION_MODE': 'IMMEDIATE',
+        'PRAGMAS': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -64 * 1024,
+        },
+    },
+}
+
+DATABASES = {
+    'default': DATABASE_PROFILES[os.environ.get('RECREATUS_DATABASE', 'development')]
+}
+
+
+# Cache
+# RECREATUS_CACHE selects locmem (default), file or redis. The redis backend needs the
+# django-redis package and works against any Redis compatible server at RECREATUS_REDIS_URL
+
+CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'recreatus',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, '.cache'),
+    },
+    'redis': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ.get('RECREATUS_REDIS_URL', 'redis://127.0.0.1:6379/1'),
+    },
+}
+
+CACHES = {
+    'default': CACHE_BACKENDS[os.environ.get('RECREATUS_CACHE', 'locmem')]
 }
 
+# Seconds a rendered fragment is kept, versions invalidate fragments before that
+FRAGMENT_CACHE_TIMEOUT = 600
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -126,3 +176,84 @@ STATIC_URL = '/static/'
 LOGIN_REDIRECT_URL = 'app:index'
 
 LOGOUT_REDIRECT_URL = 'app:login'
+
+# The first backend loads the profile along with the user, ModelBackend stays for
+# sessions of logins from before it was added
+AUTHENTICATION_BACKENDS = [
+    'app.backends.auth.ProfileBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+
+
+# Feed pagination
+# Seconds a feed's total event count stays cached, None disables the count
+
+FEED_COUNT_CACHE_TIMEOUT = 60
+
+
+# Presence tracking
+# last_online is rewritten at most once per LAST_ONLINE_STALENESS seconds per user and
+# pending timestamps are written in bulk every LAST_ONLINE_FLUSH_INTERVAL seconds
+
+LAST_ONLINE_STALENESS = 60
+
+LAST_ONLINE_FLUSH_INTERVAL = 30
+
+
+# Search
+# Falls back to app.search.DatabaseSearchBackend when the database has no FTS5 support
+
+SEARCH_BACKEND = 'app.search.SQLiteFTSSearchBackend'
+
+
+# Request profiling
+# Set RECREATUS_PROFILE=1 to record per view query counts and timings, staff can read
+# the percentiles of the last PROFILE_SAMPLES requests of every view at /profiling/report/
+
+PROFILE_REQUESTS = os.environ.get('RECREATUS_PROFILE') == '1'
+
+PROFILE_SAMPLES = 1000
+
+
+# Home timeline
+# Timelines keep the newest TIMELINE_LENGTH events. Events of profiles with more than
+# TIMELINE_FANOUT_LIMIT followers are pulled when a timeline is read instead of pushed
+
+TIMELINE_LENGTH = 500
+
+TIMELINE_FANOUT_LIMIT = 1000
+
+
+# Background tasks
+# Queued tasks are run by "manage.py run_tasks". RECREATUS_TASKS_EAGER=1 runs them inside
+# the request that queued them instead, for setups without a worker
+
+TASKS_ALWAYS_EAGER = os.environ.get('RECREATUS_TASKS_EAGER') == '1'
+
+
+# Trending
+# Activity on an event counts half as much for the trending feed after every
+# TRENDING_HALF_LIFE seconds. "manage.py compute_trending" rebuilds all scores
+
+TRENDING_HALF_LIFE = 24 * 60 * 60
+
+
+# Recommendations
+# Suggested profiles and events stored per profile by "manage.py compute_recommendations"
+
+SUGGESTIONS_PER_PROFILE = 10
+
+
+# Sessions
+# RECREATUS_SESSIONS selects db (default), cached_db or signed_cookies. cached_db reads
+# sessions from the cache and writes them through to the database, signed_cookies keeps
+# them in the cookie alone, which saves the lookup but cannot be revoked on the server.
+# "manage.py clear_expired_sessions" deletes expired database sessions in batches
+
+SESSION_ENGINES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+
+SESSION_ENGINE = SESSION_ENGINES[os.environ.get('RECREATUS_SESSIONS', 'db')]
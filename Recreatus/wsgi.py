@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Recreatus.settings')
 
 application = get_wsgi_application()
+
+# Writes last_online stamps when requests stop coming in and on shutdown
+from app.presence import tracker  # noqa: E402
+
+tracker.start()
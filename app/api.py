@@ -0,0 +1,261 @@
+import hashlib
+import json
+from datetime import datetime, time, timedelta
+from functools import wraps
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import ExpressionWrapper, F, FloatField
+from django.db.models.functions import Cast, NullIf
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_date, parse_datetime
+
+from . import schedule
+from .models import Comment, Evaluation, Event, Profile
+from .pagination import KeysetPaginator
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+EXPORT_CHUNK_SIZE = 2000
+
+
+class BadRequest(Exception):
+    """Invalid request parameters, answered with 400 by api_view."""
+
+
+class Resource:
+    """
+    Maps the field names of the API to lookups or expressions of a model.
+    Rows are read with values(), no model instances are built.
+    """
+
+    def __init__(self, fields, ordering):
+        self.fields = fields
+        self.ordering = ordering
+
+    def select(self, request):
+        """Returns the field names asked for with ?fields=, raises BadRequest for unknown ones."""
+        names = [name for name in request.GET.get('fields', '').split(',') if name]
+        unknown = [name for name in names if name not in self.fields]
+        if unknown:
+            raise BadRequest('Unknown fields: %s' % ', '.join(unknown))
+        return names or list(self.fields)
+
+    def column(self, name):
+        # Expressions get a prefix, their names may clash with model fields
+        lookup = self.fields[name]
+        return lookup if isinstance(lookup, str) else 'api_' + name
+
+    def values(self, queryset, names, extra=()):
+        annotations = {self.column(name): self.fields[name] for name in names
+                       if not isinstance(self.fields[name], str)}
+        columns = [self.column(name) for name in names]
+        return queryset.annotate(**annotations).values(*columns, *[key for key in extra if key not in columns])
+
+    def serialize(self, row, names):
+        return {name: row[self.column(name)] for name in names}
+
+    def page(self, request, queryset, names, ordering=None):
+        # The ordering fields are always fetched, the cursor is built from them
+        ordering = ordering or self.ordering
+        keys = [name.lstrip('-') for name in ordering]
+        paginator = KeysetPaginator(self.values(queryset, names, keys), page_size(request),
+                                    ordering=ordering, count_timeout=0)
+        page = paginator.page(request.GET.get('cursor', ''))
+        return {
+            "results": [self.serialize(row, names) for row in page],
+            "next": page.next_cursor,
+            "previous": page.previous_cursor
+        }
+
+
+EVENTS = Resource({
+    "id": 'id',
+    "title": 'title',
+    "description": 'description',
+    "start_time": 'start_time',
+    "end_time": 'end_time',
+    "public": 'public_flag',
+    "owner": 'owner__user_id',
+    "owner_username": 'owner__user__username',
+    "participant_count": 'participant_count',
+    "comment_count": 'comment_count'
+}, ordering=('-start_time', '-id'))
+
+PROFILES = Resource({
+    "id": 'user_id',
+    "username": 'user__username',
+    "bio": 'bio',
+    "last_online": 'last_online',
+    "rating": ExpressionWrapper(Cast('rating_sum', FloatField()) / NullIf(F('rating_count'), 0),
+                                output_field=FloatField()),
+    "rating_count": 'rating_count'
+}, ordering=('id',))
+
+COMMENTS = Resource({
+    "id": 'id',
+    "content": 'content',
+    "posted_on": 'posted_on',
+    "owner": 'owner__user_id',
+    "owner_username": 'owner__user__username',
+    "event": 'event_id'
+}, ordering=('-posted_on', '-id'))
+
+EVALUATIONS = Resource({
+    "id": 'id',
+    "grade": 'grade',
+    "grader": 'grader__user_id',
+    "event": 'event_id'
+}, ordering=('-id',))
+
+
+def page_size(request):
+    try:
+        return max(1, min(int(request.GET.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE))
+    except ValueError:
+        return PAGE_SIZE
+
+
+def api_view(view):
+    """
+    Answers unauthenticated requests with 401 instead of a login redirect,
+    bad field selections with 400 and missing objects with a JSON 404.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({"error": "Authentication required"}, status=401)
+        try:
+            return view(request, *args, **kwargs)
+        except BadRequest as error:
+            return JsonResponse({"error": str(error)}, status=400)
+        except Http404 as error:
+            return JsonResponse({"error": str(error) or 'Not found'}, status=404)
+    return wrapper
+
+
+def conditional_json(request, data):
+    """
+    JSON response with an ETag of its content. A client sending the ETag
+    back in If-None-Match gets an empty 304 when nothing changed.
+    """
+    response = JsonResponse(data, safe=False)
+    etag = '"%s"' % hashlib.md5(response.content).hexdigest()
+    response['ETag'] = etag
+    return get_conditional_response(request, etag=etag, response=response)
+
+
+def time_range(request):
+    """Aware start and end from the start and end parameters, at most schedule.CALENDAR_MAX_DAYS apart."""
+    bounds = []
+    for name in ('start', 'end'):
+        value = request.GET.get(name, '')
+        try:
+            # Both return None for other formats and raise for impossible dates
+            moment = parse_datetime(value)
+            day = parse_date(value) if moment is None else None
+        except ValueError:
+            moment = day = None
+        if moment is None:
+            if day is None:
+                raise BadRequest('%s must be a date or a date and time' % name)
+            moment = datetime.combine(day, time.min)
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        bounds.append(moment)
+    start, end = bounds
+    if not start < end <= start + timedelta(days=schedule.CALENDAR_MAX_DAYS):
+        raise BadRequest('end must be after start and at most %d days later' % schedule.CALENDAR_MAX_DAYS)
+    return start, end
+
+
+def visible_event(request, pk):
+    profile = request.user.profile
+    event = get_object_or_404(Event.objects.only('id', 'public_flag', 'owner_id'), pk=pk)
+    if not event.public_flag and event.owner_id != profile.id and \
+            not Event.invited_users.through.objects.filter(event=event, profile=profile).exists():
+        raise Http404('Event not found')
+    return event
+
+
+@api_view
+def events(request):
+    names = EVENTS.select(request)
+    return conditional_json(request, EVENTS.page(request, Event.objects.filter(public_flag=True), names))
+
+
+@api_view
+def event(request, pk):
+    names = EVENTS.select(request)
+    visible_event(request, pk)
+    row = EVENTS.values(Event.objects.filter(pk=pk), names).get()
+    return conditional_json(request, EVENTS.serialize(row, names))
+
+
+@api_view
+def event_comments(request, pk):
+    names = COMMENTS.select(request)
+    queryset = Comment.objects.filter(event=visible_event(request, pk))
+    return conditional_json(request, COMMENTS.page(request, queryset, names))
+
+
+@api_view
+def event_evaluations(request, pk):
+    names = EVALUATIONS.select(request)
+    queryset = Evaluation.objects.filter(event=visible_event(request, pk))
+    return conditional_json(request, EVALUATIONS.page(request, queryset, names))
+
+
+@api_view
+def calendar(request):
+    """
+    Events taking place between start and end, with scope=mine only the
+    ones the viewer hosts or takes part in.
+    """
+    names = EVENTS.select(request)
+    start, end = time_range(request)
+    profile = request.user.profile
+    mine = request.GET.get('scope') == 'mine'
+    events = schedule.attended_by(profile) if mine else schedule.visible_to(profile)
+    return conditional_json(request, EVENTS.page(request, schedule.overlapping(events, start, end, by_day=not mine),
+                                                 names, ordering=('start_time', 'id')))
+
+
+@api_view
+def calendar_conflicts(request):
+    """Pairs of overlapping events the viewer hosts or takes part in between start and end."""
+    start, end = time_range(request)
+    events = schedule.overlapping(schedule.attended_by(request.user.profile), start, end, by_day=False) \
+        .only('id', 'start_time', 'end_time').order_by('start_time', 'id')
+    pairs = [[first.pk, second.pk] for first, second in schedule.conflicts(events)]
+    return conditional_json(request, {"conflicts": pairs})
+
+
+@api_view
+def profiles(request):
+    names = PROFILES.select(request)
+    return conditional_json(request, PROFILES.page(request, Profile.objects.all(), names))
+
+
+@api_view
+def profile(request, pk):
+    names = PROFILES.select(request)
+    row = get_object_or_404(PROFILES.values(Profile.objects.filter(user_id=pk), names))
+    return conditional_json(request, PROFILES.serialize(row, names))
+
+
+@api_view
+def export_events(request):
+    """
+    Streams every public event as JSON Lines. Rows are read in chunks with
+    iterator(), so memory use does not grow with the number of events.
+    """
+    names = EVENTS.select(request)
+    rows = EVENTS.values(Event.objects.filter(public_flag=True).order_by('id'), names)
+    lines = (json.dumps(EVENTS.serialize(row, names), cls=DjangoJSONEncoder) + '\n'
+             for row in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+    response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+    response['Content-Disposition'] = 'attachment; filename="events.jsonl"'
+    return response
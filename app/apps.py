@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class AppConfig(AppConfig):
     name = 'app'
+
+    def ready(self):
+        # Connect the signal receivers that tune connections and keep derived
+        # data in sync, database first so the pragmas apply before anything else
+        from . import database, recommendations, schedule, search, trending, versions  # noqa: F401
@@ -0,0 +1,18 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+
+class ProfileBackend(ModelBackend):
+    """
+    ModelBackend that loads the profile in the same query as the user.
+    Nearly every view reads request.user.profile, which would otherwise be
+    a second query on every request.
+    """
+
+    def get_user(self, user_id):
+        UserModel = get_user_model()
+        try:
+            user = UserModel._default_manager.select_related('profile').get(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
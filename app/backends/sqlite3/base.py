@@ -0,0 +1,15 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    SQLite backend that starts transactions with BEGIN IMMEDIATE when the
+    database settings ask for TRANSACTION_MODE 'IMMEDIATE'. A plain BEGIN
+    takes the write lock at the first write, and a transaction that read
+    before that fails right away with "database is locked" when another
+    connection writes, busy_timeout does not apply to that upgrade.
+    """
+
+    def _start_transaction_under_autocommit(self):
+        mode = self.settings_dict.get('TRANSACTION_MODE')
+        self.cursor().execute('BEGIN %s' % mode if mode else 'BEGIN')
@@ -0,0 +1,60 @@
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class Counters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else None
+            }
+
+
+counters = Counters()
+
+
+def get_cache():
+    return caches[getattr(settings, 'FRAGMENT_CACHE_ALIAS', 'default')]
+
+
+def cached_fragment(obj, name, vary_on, render):
+    """
+    Returns the fragment called name for an Event or Profile, rendering and
+    storing it on a miss. Fragments are keyed by the version column that
+    app.versions bumps on every change, so one bump invalidates every
+    fragment of the object and no version lookups are needed.
+    """
+    cache = get_cache()
+    key = 'fragment:%s:%s:%s:%s' % (name, obj._meta.label_lower, obj.pk, obj.version)
+    if vary_on:
+        key += ':' + hashlib.md5(':'.join(str(value) for value in vary_on).encode()).hexdigest()
+
+    content = cache.get(key)
+    counters.record(content is not None)
+    if content is None:
+        content = render()
+        cache.set(key, content, getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 600))
+    return content
+
+
+def stats():
+    return counters.stats()
+
@@ -0,0 +1,17 @@
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    """
+    Runs the PRAGMAS of the database settings on every new SQLite
+    connection. Except for journal_mode, pragmas only last as long as the
+    connection, so they cannot be set once on the database file.
+    """
+    pragmas = connection.settings_dict.get('PRAGMAS')
+    if connection.vendor != 'sqlite' or not pragmas:
+        return
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
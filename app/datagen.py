@@ -0,0 +1,113 @@
+import io
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Profile, Event, Comment, Evaluation
+
+PASSWORD = 'recreatus'
+
+WORDS = ('party', 'hike', 'concert', 'football', 'chess', 'movie', 'night', 'picnic', 'tour', 'dinner', 'coffee',
+         'running', 'beach', 'museum', 'workshop', 'games', 'birthday', 'festival', 'lecture', 'meetup')
+
+
+def sentence(rng, length):
+    return ' '.join(rng.choice(WORDS) for _ in range(length)).capitalize()
+
+
+def sample(rng, population, count):
+    return rng.sample(population, min(count, len(population)))
+
+
+@transaction.atomic
+def generate(users=100, events_per_user=3, follows_per_user=10, follow_back_ratio=0.3, participants_per_event=5,
+             invites_per_event=3, comments_per_event=3, private_ratio=0.2, past_ratio=0.3, seed=0, batch_size=None):
+    """
+    Creates a synthetic data set with bulk inserts and returns the number of
+    rows created per model. Every generated user has the password PASSWORD.
+    Signals do not run for bulk inserts, so derived data (ratings, counters,
+    trending scores, calendar days, search index, suggestions) is rebuilt
+    at the end.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    # New rows are told apart from existing ones by their ids, filtering with
+    # huge IN lists would hit the database's parameter limit
+    start = User.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    last_event = Event.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    password = make_password(PASSWORD)
+
+    usernames = ['user%d' % (start + i + 1) for i in range(users)]
+    User.objects.bulk_create([User(username=name, email='%s@example.com' % name, password=password)
+                              for name in usernames], batch_size=batch_size)
+    user_ids = list(User.objects.filter(id__gt=start).values_list('id', flat=True))
+    Profile.objects.bulk_create([Profile(user_id=user_id, bio=sentence(rng, 6)) for user_id in user_ids],
+                                batch_size=batch_size)
+    profile_ids = list(Profile.objects.filter(user_id__gt=start).values_list('id', flat=True))
+
+    # following is directed, only some of the followed profiles follow back
+    Following = Profile.following.through
+    follows = set()
+    for profile_id in profile_ids:
+        for other in sample(rng, profile_ids, follows_per_user):
+            if other != profile_id:
+                follows.add((profile_id, other))
+                if rng.random() < follow_back_ratio:
+                    follows.add((other, profile_id))
+    Following.objects.bulk_create([Following(from_profile_id=a, to_profile_id=b) for a, b in follows],
+                                  batch_size=batch_size, ignore_conflicts=True)
+
+    events = []
+    for profile_id in profile_ids:
+        for _ in range(events_per_user):
+            if rng.random() < past_ratio:
+                start_time = now - timedelta(days=rng.uniform(1, 60))
+            else:
+                start_time = now + timedelta(days=rng.uniform(0, 60))
+            events.append(Event(title=sentence(rng, 3), description=sentence(rng, 20), start_time=start_time,
+                                end_time=start_time + timedelta(hours=rng.randint(1, 6)),
+                                public_flag=rng.random() >= private_ratio, owner_id=profile_id))
+    Event.objects.bulk_create(events, batch_size=batch_size)
+    event_rows = list(Event.objects.filter(id__gt=last_event).values_list('id', 'owner_id', 'end_time'))
+
+    Participant = Event.participants.through
+    Invitation = Event.invited_users.through
+    participants, invitations, comments, evaluations = [], [], [], []
+    for event_id, owner_id, end_time in event_rows:
+        guests = sample(rng, profile_ids, participants_per_event + invites_per_event)
+        guests = [guest for guest in guests if guest != owner_id]
+        attending = guests[:participants_per_event]
+        participants.extend(Participant(event_id=event_id, profile_id=guest) for guest in attending)
+        invitations.extend(Invitation(event_id=event_id, profile_id=guest) for guest in guests)
+        for _ in range(comments_per_event):
+            comments.append(Comment(content=sentence(rng, 10), owner_id=rng.choice(profile_ids), event_id=event_id,
+                                    posted_on=now - timedelta(minutes=rng.randint(0, 60 * 24 * 30))))
+        if end_time < now:
+            evaluations.extend(Evaluation(grade=rng.randint(1, 10), grader_id=guest, event_id=event_id)
+                               for guest in attending)
+    Participant.objects.bulk_create(participants, batch_size=batch_size)
+    Invitation.objects.bulk_create(invitations, batch_size=batch_size)
+    Comment.objects.bulk_create(comments, batch_size=batch_size)
+    Evaluation.objects.bulk_create(evaluations, batch_size=batch_size)
+
+    call_command('backfill_ratings', stdout=io.StringIO())
+    call_command('reconcile_counters', stdout=io.StringIO())
+    call_command('compute_trending', stdout=io.StringIO())
+    call_command('rebuild_calendar', stdout=io.StringIO())
+    call_command('rebuild_search_index', stdout=io.StringIO())
+    call_command('compute_recommendations', '--all', stdout=io.StringIO())
+
+    return {
+        "users": len(user_ids),
+        "follows": len(follows),
+        "events": len(event_rows),
+        "participants": len(participants),
+        "invitations": len(invitations),
+        "comments": len(comments),
+        "evaluations": len(evaluations)
+    }
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from app import versions
+from app.models import Evaluation, Profile
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the rating totals stored on profiles from existing evaluations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        totals = Evaluation.objects.values('event__owner').annotate(total=Sum('grade'), count=Count('id'))
+        profiles = [Profile(pk=row['event__owner'], rating_sum=row['total'], rating_count=row['count'])
+                    for row in totals]
+
+        with transaction.atomic():
+            stored = {pk: (rating_sum, rating_count) for pk, rating_sum, rating_count in
+                      Profile.objects.exclude(rating_count=0).values_list('pk', 'rating_sum', 'rating_count')}
+            Profile.objects.update(rating_sum=0, rating_count=0)
+            Profile.objects.bulk_update(profiles, ['rating_sum', 'rating_count'], batch_size=batch_size)
+            # The rating is shown on the profile page, only the pages of changed totals are touched
+            changed = {profile.pk for profile in profiles
+                       if stored.pop(profile.pk, None) != (profile.rating_sum, profile.rating_count)}
+            changed = sorted(changed | set(stored))
+            for start in range(0, len(changed), batch_size):
+                versions.touch(Profile, *changed[start:start + batch_size])
+
+        self.stdout.write(self.style.SUCCESS('Updated rating of %d profiles' % len(profiles)))
@@ -0,0 +1,208 @@
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from app import datagen
+from app.models import Profile, Event
+from app.profiling import percentile
+
+
+class Scenario:
+    """
+    Picks targets for each endpoint from the generated data. Every request
+    method returns (method, url, data) and may prepare rows beforehand,
+    that preparation is not part of the measured time.
+    """
+
+    def __init__(self, client, rng):
+        now = timezone.now()
+        self.client = client
+        self.rng = rng
+        self.viewer = Profile.objects.select_related('user').order_by('id').first()
+        self.user_ids = list(Profile.objects.values_list('user_id', flat=True))
+        self.public_events = list(Event.objects.filter(public_flag=True).values_list('id', flat=True))
+        self.upcoming = list(Event.objects.filter(public_flag=True, end_time__gt=now)
+                             .values_list('id', 'owner__user_id'))
+        self.past = list(Event.objects.filter(end_time__lt=now).values_list('id', 'owner_id'))
+        self.profile_ids = list(Profile.objects.values_list('id', flat=True))
+        self.words = list(datagen.WORDS)
+        self.login(self.viewer.user_id)
+
+    def login(self, user_id):
+        self.client.force_login(Profile.objects.get(user_id=user_id).user)
+
+    def index(self):
+        return 'get', reverse('app:index'), None
+
+    def private_events(self):
+        return 'get', reverse('app:private_events'), None
+
+    def event_detail(self):
+        return 'get', reverse('app:event_detail', args=[self.rng.choice(self.public_events)]), None
+
+    def user_detail(self):
+        return 'get', reverse('app:user_detail', args=[self.rng.choice(self.user_ids)]), None
+
+    def search_events(self):
+        return 'get', reverse('app:search'), {'query': self.rng.choice(self.words), 'type': 'events'}
+
+    def search_users(self):
+        return 'get', reverse('app:search'), {'query': 'user%d' % self.rng.randint(1, 9), 'type': 'users'}
+
+    def create_event(self):
+        start = timezone.now() + timedelta(days=self.rng.randint(1, 30))
+        return 'post', reverse('app:create_event'), {
+            'title': datagen.sentence(self.rng, 3), 'description': datagen.sentence(self.rng, 20),
+            'start_time': start.strftime('%Y-%m-%d %H:%M'),
+            'end_time': (start + timedelta(hours=2)).strftime('%Y-%m-%d %H:%M'), 'public_flag': 'on'}
+
+    def comment(self):
+        url = reverse('app:comment', args=[self.rng.choice(self.public_events)])
+        return 'post', url, {'content': datagen.sentence(self.rng, 10)}
+
+    def participation(self):
+        event_id = self.rng.choice(self.upcoming)[0]
+        return 'get', reverse('app:participation', args=[event_id]), {
+            'participation': self.rng.choice(['true', 'false'])}
+
+    def follow_user(self):
+        return 'get', reverse('app:follow_user', args=[self.rng.choice(self.user_ids)]), {
+            'follow': self.rng.choice(['true', 'false'])}
+
+    def invite_users(self):
+        event_id, owner_user_id = self.rng.choice(self.upcoming)
+        self.login(owner_user_id)
+        return 'post', reverse('app:invite_users', args=[event_id]), {
+            'invited_users': datagen.sample(self.rng, self.user_ids, 20)}
+
+    def rate_event(self):
+        event_id, owner_id = self.rng.choice(self.past)
+        profile_id = self.rng.choice([pk for pk in datagen.sample(self.rng, self.profile_ids, 5) if pk != owner_id])
+        Event.participants.through.objects.get_or_create(event_id=event_id, profile_id=profile_id)
+        self.login(Profile.objects.get(pk=profile_id).user_id)
+        return 'post', reverse('app:rate_event', args=[event_id]), {'grade': self.rng.randint(1, 10)}
+
+
+ENDPOINTS = ('index', 'private_events', 'event_detail', 'user_detail', 'search_events', 'search_users',
+             'create_event', 'comment', 'participation', 'follow_user', 'invite_users', 'rate_event')
+
+
+def summarize(latencies, queries, statuses, elapsed=None):
+    # Serial runs report throughput over the time spent in requests only,
+    # concurrent runs over the wall time of the whole batch
+    ordered = sorted(latencies)
+    total = elapsed or sum(latencies)
+    return {
+        "requests": len(statuses),
+        "statuses": sorted(set(statuses)),
+        "queries": {"mean": sum(queries) / len(queries), "max": max(queries)},
+        "latency_ms": {
+            "p50": percentile(ordered, 0.5) * 1000,
+            "p95": percentile(ordered, 0.95) * 1000,
+            "max": ordered[-1] * 1000
+        },
+        "throughput_rps": len(latencies) / total if total else None
+    }
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the views on generated data sets of several sizes and prints a JSON report'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='100,1000', help='comma separated numbers of generated users')
+        parser.add_argument('--requests', type=int, default=50, help='requests per endpoint and size')
+        parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='threads sending requests at the same time, each with its own client')
+        parser.add_argument('--database-file',
+                            help='run on a SQLite file instead of in memory, so the pragmas of the '
+                                 'database profile (RECREATUS_DATABASE) take effect')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='file to write the report to, stdout by default')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        endpoints = options['endpoints'].split(',')
+        report = {"requests_per_endpoint": options['requests'], "concurrency": options['concurrency'], "sizes": {}}
+
+        # Each size runs on a throwaway test database, the real one is never touched
+        if options['database_file']:
+            connection.settings_dict['TEST']['NAME'] = options['database_file']
+        setup_test_environment(debug=False)
+        try:
+            for size in sizes:
+                old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+                try:
+                    cache.clear()
+                    data = datagen.generate(users=size, seed=options['seed'])
+                    results = self.run(endpoints, options['requests'], random.Random(options['seed']),
+                                       options['concurrency'])
+                    report['sizes'][str(size)] = {"data": data, "endpoints": results}
+                finally:
+                    connection.creation.destroy_test_db(old_name, verbosity=0)
+                self.stderr.write('Finished %d users' % size)
+        finally:
+            teardown_test_environment()
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output)
+        else:
+            self.stdout.write(output)
+
+    def run(self, endpoints, requests, rng, concurrency):
+        results = {}
+        for endpoint in endpoints:
+            if concurrency == 1:
+                results[endpoint] = summarize(*self.measure(Scenario(Client(), rng), endpoint, requests))
+                continue
+
+            # Scenarios log in their clients, that is done before the clock starts
+            scenarios = [Scenario(Client(), random.Random(rng.random())) for _ in range(concurrency)]
+            shares = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                start = time.perf_counter()
+                futures = [executor.submit(self.measure_in_thread, scenario, endpoint, share)
+                           for scenario, share in zip(scenarios, shares)]
+                samples = [future.result() for future in futures]
+                elapsed = time.perf_counter() - start
+            latencies, queries, statuses = ([value for sample in samples for value in sample[i]] for i in range(3))
+            results[endpoint] = summarize(latencies, queries, statuses, elapsed)
+        return results
+
+    def measure(self, scenario, endpoint, requests):
+        latencies, queries, statuses = [], [], []
+        for _ in range(requests):
+            # Typically "database is locked" with concurrent writers, counted as a failed request
+            try:
+                method, url, data = getattr(scenario, endpoint)()
+            except DatabaseError:
+                statuses.append(500)
+                continue
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                try:
+                    status = getattr(scenario.client, method)(url, data).status_code
+                except DatabaseError:
+                    status = 500
+                latencies.append(time.perf_counter() - start)
+            queries.append(len(context))
+            statuses.append(status)
+        return latencies, queries, statuses
+
+    def measure_in_thread(self, scenario, endpoint, requests):
+        try:
+            return self.measure(scenario, endpoint, requests)
+        finally:
+            connection.close()
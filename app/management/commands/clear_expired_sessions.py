@@ -0,0 +1,32 @@
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = ('Deletes expired sessions in batches. Unlike clearsessions no single statement holds the '
+            'database lock for long')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        if not hasattr(store, 'get_model_class'):
+            # Cookie sessions expire on their own, cache and file stores clean up themselves
+            store.clear_expired()
+            self.stdout.write('%s does not keep sessions in the database' % settings.SESSION_ENGINE)
+            return
+
+        model = store.get_model_class()
+        now = timezone.now()
+        deleted = 0
+        while True:
+            keys = list(model.objects.filter(expire_date__lt=now).values_list('pk', flat=True)
+                        [:options['batch_size']])
+            if not keys:
+                break
+            deleted += model.objects.filter(pk__in=keys).delete()[0]
+        self.stdout.write(self.style.SUCCESS('Deleted %d expired sessions' % deleted))
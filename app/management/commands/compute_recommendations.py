@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app import recommendations
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the suggested profiles and events of profiles whose network changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='recompute every profile from the whole graph')
+        parser.add_argument('--limit', type=int, default=None, help='stale profiles to recompute at most')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        if options['all']:
+            computed = recommendations.rebuild()
+        else:
+            computed = recommendations.refresh(limit=options['limit'])
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS('Computed suggestions of %d profiles in %.1f seconds'
+                                             % (computed, elapsed)))
@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app import trending
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the trending scores of all public events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        ranked = trending.rebuild(batch_size=options['batch_size'])
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS('Ranked %d events in %.1f seconds' % (ranked, elapsed)))
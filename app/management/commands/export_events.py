@@ -0,0 +1,35 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from app import transfer
+from app.models import Event
+
+
+class Command(BaseCommand):
+    help = 'Streams events with their participants, invitations, comments and evaluations to CSV or JSON Lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='file to write, stdout by default')
+        parser.add_argument('--format', choices=('csv', 'jsonl'), help='by default taken from the file extension')
+        parser.add_argument('--owner', help='only events hosted by this username')
+        parser.add_argument('--chunk-size', type=int, default=transfer.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or transfer.file_format(options['path'])
+        events = Event.objects.all()
+        if options['owner']:
+            events = events.filter(owner__user__username=options['owner'])
+
+        start = time.perf_counter()
+        records = transfer.export_records(events, chunk_size=options['chunk_size'])
+        if options['path']:
+            with open(options['path'], 'w', newline='', encoding='utf-8') as file:
+                rows = transfer.write_records(records, file, file_format)
+        else:
+            rows = transfer.write_records(records, sys.stdout, file_format)
+        elapsed = time.perf_counter() - start
+        # Progress goes to stderr, stdout may be the export itself
+        self.stderr.write(self.style.SUCCESS('Exported %d rows in %.1f seconds, %d rows/s'
+                                             % (rows, elapsed, rows / elapsed if elapsed else 0)))
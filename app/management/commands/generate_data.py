@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from app import datagen
+
+
+class Command(BaseCommand):
+    help = 'Fills the database with a synthetic data set of users, follows, events, comments and evaluations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--events-per-user', type=int, default=3)
+        parser.add_argument('--follows-per-user', type=int, default=10)
+        parser.add_argument('--follow-back-ratio', type=float, default=0.3,
+                            help='share of follows that are returned')
+        parser.add_argument('--participants-per-event', type=int, default=5)
+        parser.add_argument('--invites-per-event', type=int, default=3)
+        parser.add_argument('--comments-per-event', type=int, default=3)
+        parser.add_argument('--private-ratio', type=float, default=0.2)
+        parser.add_argument('--past-ratio', type=float, default=0.3)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, help='rows per insert, by default the most the database allows')
+
+    def handle(self, *args, **options):
+        counts = datagen.generate(
+            users=options['users'], events_per_user=options['events_per_user'],
+            follows_per_user=options['follows_per_user'], follow_back_ratio=options['follow_back_ratio'],
+            participants_per_event=options['participants_per_event'],
+            invites_per_event=options['invites_per_event'], comments_per_event=options['comments_per_event'],
+            private_ratio=options['private_ratio'], past_ratio=options['past_ratio'], seed=options['seed'],
+            batch_size=options['batch_size'])
+        for name, count in counts.items():
+            self.stdout.write('%s: %d' % (name, count))
+        self.stdout.write(self.style.SUCCESS('Generated data, every user has the password "%s"' % datagen.PASSWORD))
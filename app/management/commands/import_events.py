@@ -0,0 +1,53 @@
+import io
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from app import transfer
+
+
+class Command(BaseCommand):
+    help = ('Imports events with their participants, invitations, comments and evaluations from CSV or JSON '
+            'Lines, as written by export_events. Records are validated like CreateEventForm, invalid ones are '
+            'reported and skipped')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=('csv', 'jsonl'), help='by default taken from the file extension')
+        parser.add_argument('--chunk-size', type=int, default=transfer.CHUNK_SIZE,
+                            help='records validated and written per transaction')
+        parser.add_argument('--batch-size', type=int, help='rows per insert, by default the most the database allows')
+        parser.add_argument('--dry-run', action='store_true', help='only validate')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or transfer.file_format(options['path'])
+        totals, valid, rejected = {}, 0, 0
+        start = time.perf_counter()
+        with open(options['path'], newline='', encoding='utf-8') as file:
+            chunks = transfer.import_records(transfer.read_records(file, file_format), options['chunk_size'],
+                                             options['batch_size'], options['dry_run'])
+            for records, written, errors in chunks:
+                valid += records
+                rejected += len(errors)
+                for number, message in errors:
+                    self.stderr.write('Line %d: %s' % (number, message))
+                for name, count in written.items():
+                    totals[name] = totals.get(name, 0) + count
+                if options['verbosity'] > 1:
+                    self.report(sum(totals.values()), time.perf_counter() - start)
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS('%d valid records, %d rejected' % (valid, rejected)))
+            return
+
+        # Scores are rebuilt once rather than per record
+        call_command('compute_trending', stdout=io.StringIO())
+        for name, count in totals.items():
+            self.stdout.write('%s: %d' % (name, count))
+        if rejected:
+            self.stdout.write(self.style.WARNING('Rejected %d records' % rejected))
+        self.report(sum(totals.values()), time.perf_counter() - start)
+
+    def report(self, rows, elapsed):
+        self.stdout.write(self.style.SUCCESS('Imported %d rows in %.1f seconds, %d rows/s'
+                                             % (rows, elapsed, rows / elapsed if elapsed else 0)))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from app.models import Event
+
+
+class Command(BaseCommand):
+    help = 'Invites users to an event in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('event_id', type=int)
+        parser.add_argument('user_ids', nargs='*', help='ids of the users to invite')
+        parser.add_argument('--following', action='store_true',
+                            help='invite every user the host of the event follows')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        try:
+            event = Event.objects.select_related('owner').get(pk=options['event_id'])
+        except Event.DoesNotExist:
+            raise CommandError('Event %s does not exist' % options['event_id'])
+
+        user_ids = list(options['user_ids'])
+        if options['following']:
+            user_ids.extend(event.owner.following.values_list('user_id', flat=True))
+        if not user_ids:
+            raise CommandError('Pass user ids or --following')
+
+        with transaction.atomic():
+            invited, skipped = event.invite(user_ids, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Invited %d users to "%s", skipped %d' % (invited, event, skipped)))
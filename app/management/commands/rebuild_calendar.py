@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app import schedule
+
+
+class Command(BaseCommand):
+    help = 'Recreates the day index the calendar uses for range queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            written = schedule.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Indexed %d event days' % written))
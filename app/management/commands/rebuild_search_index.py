@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app.search import get_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search index of events and users'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        with transaction.atomic():
+            counts = backend.rebuild(batch_size=options['batch_size'])
+        if not counts:
+            self.stdout.write('%s does not keep an index, nothing to rebuild' % type(backend).__name__)
+        for table, count in counts.items():
+            self.stdout.write(self.style.SUCCESS('Indexed %d rows into %s' % (count, table)))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from app.models import Comment, Event
+
+
+def counted(queryset):
+    # COUNT(*) of the rows belonging to the outer event, 0 when there are none
+    rows = queryset.filter(event=OuterRef('pk')).order_by().values('event').annotate(count=Count('*'))
+    return Coalesce(Subquery(rows.values('count'), output_field=IntegerField()), 0)
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the participant and comment counters stored on events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='only report how many events have drifted')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        participants = counted(Event.participants.through.objects.all())
+        comments = counted(Comment.objects.all())
+
+        with transaction.atomic():
+            drifted = Event.objects.annotate(actual_participants=participants, actual_comments=comments).exclude(
+                participant_count=F('actual_participants'), comment_count=F('actual_comments'))
+            drifted_ids = list(drifted.values_list('id', flat=True))
+            if not options['dry_run']:
+                batch_size = options['batch_size']
+                for start in range(0, len(drifted_ids), batch_size):
+                    Event.objects.filter(pk__in=drifted_ids[start:start + batch_size]).update(
+                        participant_count=participants, comment_count=comments)
+
+        verb = 'Found' if options['dry_run'] else 'Repaired'
+        self.stdout.write(self.style.SUCCESS('%s %d events with drifted counters' % (verb, len(drifted_ids))))
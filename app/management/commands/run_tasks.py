@@ -0,0 +1,45 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+from app import tasks
+
+
+def run(task_id):
+    close_old_connections()
+    try:
+        return tasks.execute(task_id)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Runs queued background tasks on a pool of worker threads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='seconds to sleep when the queue is empty')
+        parser.add_argument('--lock-timeout', type=int, default=300,
+                            help='seconds after which a running task is considered abandoned')
+        parser.add_argument('--once', action='store_true', help='exit once no task is due')
+
+    def handle(self, *args, **options):
+        succeeded = failed = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            while True:
+                tasks.release_stale(options['lock_timeout'])
+                claimed = [task_id for task_id in tasks.due_tasks(options['workers'] * 4) if tasks.claim(task_id)]
+                if not claimed:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+                done, _ = wait([pool.submit(run, task_id) for task_id in claimed])
+                for future in done:
+                    if future.result():
+                        succeeded += 1
+                    else:
+                        failed += 1
+        self.stdout.write(self.style.SUCCESS('Ran %d tasks, %d failed' % (succeeded + failed, failed)))
@@ -1,6 +1,11 @@
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
 from django.utils import timezone
-from .models import Profile
+from . import profiling
+from .presence import tracker
 import pytz
+import time
 
 
 class UpdateLastActivityMiddleware:
@@ -12,7 +17,7 @@ class UpdateLastActivityMiddleware:
         # the view (and later middleware) are called.
 
         if request.user.is_authenticated:
-            Profile.objects.filter(user__id=request.user.id).update(last_online=timezone.now())
+            tracker.touch(request.user.id)
 
         response = self.get_response(request)
 
@@ -33,3 +38,30 @@ class TimezoneMiddleware:
         else:
             timezone.deactivate()
         return self.get_response(request)
+
+
+class ProfilingMiddleware:
+    """
+    Records query count, database time, template render time and wall time
+    of every request under the URL name of its view. Enabled with the
+    PROFILE_REQUESTS setting, the report is served at profiling/report/.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILE_REQUESTS', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sample = profiling.start_sample()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(sample.record_query):
+                response = self.get_response(request)
+        finally:
+            profiling.finish_sample()
+        sample.wall_time = time.perf_counter() - start
+
+        match = request.resolver_match
+        profiling.recorder.add(match.view_name if match else 'unresolved', sample)
+        return response
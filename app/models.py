@@ -1,21 +1,70 @@
+from datetime import timedelta
+
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db import models
+from django.db.models import Exists, F, OuterRef, Q
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from django.utils import timezone
 
 
+def saved_fields(instance, derived):
+    """
+    Fields a full save of an existing row writes. Derived columns are kept
+    up by F() updates elsewhere, a stale instance would write them back.
+    """
+    skipped = set(derived) | instance.get_deferred_fields()
+    return [field.attname for field in instance._meta.concrete_fields
+            if not field.primary_key and field.attname not in skipped]
+
+
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     bio = models.TextField(max_length=200, blank=True)
     last_online = models.DateTimeField(default=timezone.now)
 
+    # Running totals of the grades given to events hosted by this profile
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+
+    # Set once the profile has too many followers to push events to each of
+    # their timelines, followers pull this profile's events when reading
+    fanout_on_read = models.BooleanField(default=False)
+
     following = models.ManyToManyField('Profile', related_name='followers', blank=True)
 
+    # Bumped by every write that changes the profile page, see app.versions
+    updated_at = models.DateTimeField(default=timezone.now, editable=False)
+    version = models.PositiveIntegerField(default=1, editable=False)
+
+    # Set when follows or participations near the profile change, the next
+    # "manage.py compute_recommendations" recomputes its suggestions
+    suggestions_stale = models.BooleanField(default=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], name='profile_suggestions_stale_idx', condition=Q(suggestions_stale=True)),
+        ]
+
+    # Never written by save(), see saved_fields()
+    DERIVED_FIELDS = ('rating_sum', 'rating_count', 'updated_at', 'version', 'suggestions_stale')
+
     def __str__(self):
         return self.user.username
 
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if update_fields is None and not force_insert and not self._state.adding:
+            update_fields = saved_fields(self, self.DERIVED_FIELDS)
+        super().save(force_insert, force_update, using, update_fields)
+
+    @property
+    def rating(self):
+        if self.rating_count == 0:
+            return None
+        return self.rating_sum / self.rating_count
+
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -28,20 +77,113 @@ def save_user_profile(sender, instance, **kwargs):
     instance.profile.save()
 
 
+class EventQuerySet(models.QuerySet):
+    def for_listing(self):
+        # Everything _event.html needs, fetched in the listing query itself
+        return self.select_related('owner__user')
+
+    def with_viewer_state(self, profile):
+        # Relation of the viewing profile to each event as EXISTS subqueries
+        invited_users = Event.invited_users.through.objects.filter(event=OuterRef('pk'), profile=profile)
+        participants = Event.participants.through.objects.filter(event=OuterRef('pk'), profile=profile)
+        evaluations = Evaluation.objects.filter(event=OuterRef('pk'), grader=profile)
+        return self.annotate(is_invited=Exists(invited_users), is_participant=Exists(participants),
+                             has_rated=Exists(evaluations))
+
+    def private_for(self, profile):
+        # Invitations are matched with a subquery rather than a join, so an
+        # event shows up once even when its host also invited themself
+        invitations = Event.invited_users.through.objects.filter(profile=profile).values('event_id')
+        return self.filter(public_flag=False).filter(Q(owner=profile) | Q(pk__in=invitations))
+
+
 class Event(models.Model):
+    # Longest event accepted by clean(), app.schedule indexes one row per day
+    MAX_DAYS = 366
+
     title = models.CharField(max_length=100)
     description = models.TextField()
     start_time = models.DateTimeField()
     end_time = models.DateTimeField()
     public_flag = models.BooleanField(default=True)
 
+    # Kept in sync by the receivers below, "manage.py reconcile_counters"
+    # repairs drift from bulk inserts or cascading deletes
+    participant_count = models.PositiveIntegerField(default=0, editable=False)
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+
+    # Bumped by every write that changes the event page, see app.versions
+    updated_at = models.DateTimeField(default=timezone.now, editable=False)
+    version = models.PositiveIntegerField(default=1, editable=False)
+
     owner = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='hosted_events')
     participants = models.ManyToManyField('Profile', related_name='events_participating', blank=True)
     invited_users = models.ManyToManyField('Profile', related_name='events_invited_to', blank=True)
 
+    objects = EventQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Public feed, WHERE public_flag ORDER BY start_time DESC, id DESC
+            models.Index(fields=['-start_time', '-id'], name='event_public_feed_idx', condition=Q(public_flag=True)),
+            # Hosted events of a profile, newest first
+            models.Index(fields=['owner', '-start_time'], name='event_owner_start_idx'),
+            # Ended / upcoming checks
+            models.Index(fields=['end_time'], name='event_end_time_idx'),
+        ]
+
+    # Never written by save(), see saved_fields()
+    DERIVED_FIELDS = ('participant_count', 'comment_count', 'updated_at', 'version')
+
     def __str__(self):
         return self.title
 
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if update_fields is None and not force_insert and not self._state.adding:
+            update_fields = saved_fields(self, self.DERIVED_FIELDS)
+        super().save(force_insert, force_update, using, update_fields)
+
+    def clean(self):
+        if self.start_time is None or self.end_time is None:
+            return
+        if self.end_time <= self.start_time:
+            raise ValidationError({'end_time': 'The event has to end after it starts.'})
+        if self.end_time - self.start_time > timedelta(days=self.MAX_DAYS):
+            raise ValidationError({'end_time': 'Events can last at most %d days.' % self.MAX_DAYS})
+
+    def invite(self, user_ids, batch_size=500):
+        """
+        Invites the profiles of the given users with a fixed number of
+        queries per batch. Returns how many were invited and how many were
+        skipped as invalid, unknown or already invited.
+        """
+        requested = list(user_ids)
+        ids = set()
+        for user_id in requested:
+            try:
+                ids.add(int(user_id))
+            except (TypeError, ValueError):
+                pass
+
+        Invitation = self.invited_users.through
+        invited = 0
+        ids = sorted(ids)
+        for start in range(0, len(ids), batch_size):
+            profile_ids = set(Profile.objects.filter(user_id__in=ids[start:start + batch_size])
+                              .values_list('id', flat=True))
+            # Existing invitations are only read for the skipped count, a
+            # concurrent invite of the same profile is ignored by the insert
+            profile_ids -= set(Invitation.objects.filter(event=self, profile_id__in=profile_ids)
+                               .values_list('profile_id', flat=True))
+            if profile_ids:
+                Invitation.objects.bulk_create([Invitation(event=self, profile_id=profile_id)
+                                                for profile_id in profile_ids], ignore_conflicts=True)
+                # What add() would send, the cache and version receivers listen to it
+                m2m_changed.send(sender=Invitation, instance=self, action='post_add', reverse=False,
+                                 model=Profile, pk_set=profile_ids, using=self._state.db)
+                invited += len(profile_ids)
+        return invited, len(requested) - invited
+
 
 class Comment(models.Model):
     content = models.TextField()
@@ -50,17 +192,168 @@ class Comment(models.Model):
     owner = models.ForeignKey(Profile, on_delete=models.CASCADE)
     event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='comments')
 
+    class Meta:
+        indexes = [
+            # Comments of an event in posting order
+            models.Index(fields=['event', 'posted_on'], name='comment_event_posted_idx'),
+        ]
+
     def __str__(self):
         return self.content
 
 
+@receiver(m2m_changed, sender=Event.participants.through)
+def update_participant_count(sender, instance, action, reverse, pk_set, **kwargs):
+    # pk_set of post_add only holds the rows actually added. Removals are
+    # counted before the rows go, in the same transaction as the delete
+    if action not in ('post_add', 'pre_remove', 'pre_clear'):
+        return
+    delta = 1 if action == 'post_add' else -1
+    rows = sender.objects.filter(**{'profile' if reverse else 'event': instance})
+    if pk_set is not None:
+        rows = rows.filter(**{'event__in' if reverse else 'profile__in': pk_set})
+
+    if reverse:
+        # One profile joined or left several events, each changes by one
+        Event.objects.filter(pk__in=rows.values('event_id')).update(participant_count=F('participant_count') + delta)
+    else:
+        changed = len(pk_set) if action == 'post_add' else rows.count()
+        if changed:
+            Event.objects.filter(pk=instance.pk).update(participant_count=F('participant_count') + delta * changed)
+
+
+@receiver(pre_delete, sender=Profile)
+def remove_participant_from_counts(sender, instance, **kwargs):
+    # The cascade deletes the participant rows without m2m_changed
+    participating = Event.participants.through.objects.filter(profile=instance).values('event_id')
+    Event.objects.filter(pk__in=participating).update(participant_count=F('participant_count') - 1)
+
+
+@receiver(post_save, sender=Comment)
+def add_comment_to_count(sender, instance, created, **kwargs):
+    if created:
+        Event.objects.filter(pk=instance.event_id).update(comment_count=F('comment_count') + 1)
+
+
+@receiver(post_delete, sender=Comment)
+def remove_comment_from_count(sender, instance, **kwargs):
+    Event.objects.filter(pk=instance.event_id).update(comment_count=F('comment_count') - 1)
+
+
+class EventDay(models.Model):
+    # One row for every UTC day an event spans, range queries find their
+    # candidates through the (day, event) index, see app.schedule
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='days')
+    day = models.DateField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'event'], name='eventday_day_event_unique'),
+        ]
+
+
+class TimelineEntry(models.Model):
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='timeline')
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='+')
+    # Copied from the event so a timeline page is read from this table alone
+    start_time = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['profile', 'event'], name='timeline_profile_event_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['profile', '-start_time', '-event'], name='timeline_profile_start_idx'),
+        ]
+
+
+class TrendingScore(models.Model):
+    event = models.OneToOneField(Event, on_delete=models.CASCADE, primary_key=True, related_name='trending_score')
+    # log2 of the time decayed activity of the event, see app.trending
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-score', '-event'], name='trending_score_idx'),
+        ]
+
+
+class SuggestedProfile(models.Model):
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='suggested_profiles')
+    suggested = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='+')
+    # Mutual follows plus shared events, see app.recommendations
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['profile', '-score'], name='suggested_profile_idx'),
+        ]
+
+
+class SuggestedEvent(models.Model):
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='suggested_events')
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='+')
+    # Number of followed profiles attending the event
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['profile', '-score'], name='suggested_event_idx'),
+        ]
+
+
 class Evaluation(models.Model):
     grade = models.IntegerField(validators=[MinValueValidator(1), MaxValueValidator(10)])
 
     grader = models.ForeignKey(Profile, on_delete=models.DO_NOTHING)
     event = models.ForeignKey(Event, on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [
+            # One grade per participant, also serves the (grader, event) lookups
+            models.UniqueConstraint(fields=['grader', 'event'], name='evaluation_grader_event_unique'),
+        ]
+
     def __str__(self):
         return self.grader.user.username + '->' + self.event.owner.user.username + '->' + self.grade
 
 
+@receiver(post_save, sender=Evaluation)
+def add_evaluation_to_rating(sender, instance, created, **kwargs):
+    if created:
+        Profile.objects.filter(hosted_events=instance.event_id).update(
+            rating_sum=F('rating_sum') + instance.grade, rating_count=F('rating_count') + 1)
+
+
+@receiver(post_delete, sender=Evaluation)
+def remove_evaluation_from_rating(sender, instance, **kwargs):
+    Profile.objects.filter(hosted_events=instance.event_id).update(
+        rating_sum=F('rating_sum') - instance.grade, rating_count=F('rating_count') - 1)
+
+
+class Task(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'))
+
+    name = models.CharField(max_length=100)
+    # JSON encoded positional arguments
+    arguments = models.TextField(default='[]')
+    idempotency_key = models.CharField(max_length=200, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_on = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='task_status_run_after_idx'),
+        ]
+
+    def __str__(self):
+        return '%s(%s) %s' % (self.name, self.arguments, self.status)
@@ -0,0 +1,123 @@
+import hashlib
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+CURSOR_SALT = 'app.pagination.cursor'
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None, count=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.count = count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class KeysetPaginator:
+    """
+    Cursor based paginator. Pages are selected with a WHERE clause on the
+    ordering key instead of OFFSET, so every page costs the same no matter
+    how deep it is. All ordering fields must share the same direction and
+    the last one has to be unique (usually the primary key). Querysets of
+    values() work too, as long as their rows include the ordering fields.
+    """
+
+    def __init__(self, queryset, per_page, ordering=('-start_time', '-id'), count_timeout=None):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = tuple(ordering)
+        self.descending = self.ordering[0].startswith('-')
+        self.fields = [name.lstrip('-') for name in self.ordering]
+        if count_timeout is None:
+            count_timeout = getattr(settings, 'FEED_COUNT_CACHE_TIMEOUT', None)
+        self.count_timeout = count_timeout
+
+    def page(self, cursor=None):
+        direction, values = self._decode(cursor)
+        backwards = direction == 'prev'
+
+        queryset = self.queryset
+        if values is not None:
+            queryset = queryset.filter(self._after(values, backwards))
+        if backwards:
+            queryset = queryset.order_by(*[self._flip(name) for name in self.ordering])
+        else:
+            queryset = queryset.order_by(*self.ordering)
+
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+
+        next_cursor = previous_cursor = None
+        if rows:
+            if has_more or backwards:
+                next_cursor = self._encode('next', rows[-1])
+            if values is not None and (has_more or not backwards):
+                previous_cursor = self._encode('prev', rows[0])
+        return KeysetPage(rows, next_cursor, previous_cursor, self.count())
+
+    def count(self):
+        if not self.count_timeout:
+            return None
+        key = 'feed-count:' + hashlib.md5(str(self.queryset.query).encode()).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = self.queryset.count()
+            cache.set(key, count, self.count_timeout)
+        return count
+
+    def _after(self, values, backwards):
+        # Row comparison (a, b) < (x, y) expanded to a < x OR (a = x AND b < y)
+        lookup = 'gt' if self.descending == backwards else 'lt'
+        condition = Q()
+        for i, name in enumerate(self.fields):
+            term = Q(**{'%s__%s' % (name, lookup): values[i]})
+            for prev_name, prev_value in zip(self.fields[:i], values[:i]):
+                term &= Q(**{prev_name: prev_value})
+            condition |= term
+        return condition
+
+    def _encode(self, direction, obj):
+        model = self.queryset.model
+        fields = [model._meta.get_field(name) for name in self.fields]
+        if isinstance(obj, dict):
+            obj = SimpleNamespace(**{field.attname: obj[name] for name, field in zip(self.fields, fields)})
+        values = [field.value_to_string(obj) for field in fields]
+        return signing.dumps([direction] + values, salt=CURSOR_SALT, compress=True)
+
+    def _decode(self, cursor):
+        if not cursor:
+            return 'next', None
+        try:
+            data = signing.loads(cursor, salt=CURSOR_SALT)
+            direction, raw_values = data[0], data[1:]
+            model = self.queryset.model
+            values = [model._meta.get_field(name).to_python(value) for name, value in zip(self.fields, raw_values)]
+        except (signing.BadSignature, ValidationError, ValueError, TypeError, IndexError):
+            return 'next', None
+        if direction not in ('next', 'prev') or len(values) != len(self.fields):
+            return 'next', None
+        return direction, values
+
+    @staticmethod
+    def _flip(name):
+        return name[1:] if name.startswith('-') else '-' + name
@@ -0,0 +1,116 @@
+import atexit
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+from django.db.models import Case, When, Value, DateTimeField, F
+from django.utils import timezone
+
+from .models import Profile
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceTracker:
+    """
+    Collects last_online timestamps in memory and writes them in one
+    UPDATE per flush interval instead of one UPDATE per request. A user's
+    timestamp is only rewritten once the previous write is older than the
+    staleness window, every other touch is counted as coalesced.
+
+    Requests only flush when they come in, start() adds a thread that
+    flushes on the interval when traffic stops and a last flush on exit.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.written = {}
+        self.last_flush = time.monotonic()
+        self.flusher = None
+        self.touches = 0
+        self.writes = 0
+        self.flushes = 0
+
+    @property
+    def staleness(self):
+        return getattr(settings, 'LAST_ONLINE_STALENESS', 60)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'LAST_ONLINE_FLUSH_INTERVAL', 30)
+
+    def touch(self, user_id):
+        now = timezone.now()
+        with self.lock:
+            self.touches += 1
+            last_written = self.written.get(user_id)
+            if last_written is None or (now - last_written).total_seconds() >= self.staleness:
+                self.pending[user_id] = now
+            should_flush = time.monotonic() - self.last_flush >= self.flush_interval
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+        if not pending:
+            return 0
+
+        cases = [When(user_id=user_id, then=Value(stamp)) for user_id, stamp in pending.items()]
+        profiles = Profile.objects.filter(user_id__in=pending.keys())
+        try:
+            # The profile page shows last_online, its version moves along
+            profiles.update(last_online=Case(*cases, output_field=DateTimeField()),
+                            version=F('version') + 1, updated_at=timezone.now())
+        except DatabaseError:
+            # Put the timestamps back unless a newer touch already replaced them
+            logger.exception('Failed to flush %d last_online timestamps', len(pending))
+            with self.lock:
+                for user_id, stamp in pending.items():
+                    self.pending.setdefault(user_id, stamp)
+            return 0
+
+        with self.lock:
+            self.written.update(pending)
+            # Stamps older than the staleness window no longer hold back a write
+            cutoff = timezone.now() - timedelta(seconds=self.staleness)
+            self.written = {user_id: stamp for user_id, stamp in self.written.items() if stamp > cutoff}
+            self.writes += len(pending)
+            self.flushes += 1
+        logger.debug('Flushed %d last_online timestamps', len(pending))
+        return len(pending)
+
+    def start(self):
+        """Starts the background flusher of a serving process, once."""
+        with self.lock:
+            if self.flusher is not None:
+                return
+            self.flusher = threading.Thread(target=self.run, name='presence-flusher', daemon=True)
+        self.flusher.start()
+        atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+            # The thread keeps its own connection, closed like a request's would be
+            close_old_connections()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "touches": self.touches,
+                "writes": self.writes,
+                "coalesced": self.touches - self.writes - len(self.pending),
+                "pending": len(self.pending),
+                "flushes": self.flushes
+            }
+
+
+tracker = PresenceTracker()
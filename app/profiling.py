@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import defaultdict, deque
+
+from django.conf import settings
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+
+local = threading.local()
+
+
+class Sample:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.wall_time = 0.0
+
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - start
+
+
+def percentile(ordered, fraction):
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Recorder:
+    """
+    Keeps the most recent samples of every view and summarizes them as
+    percentiles. Times are reported in milliseconds.
+    """
+
+    metrics = ('queries', 'db_time', 'template_time', 'wall_time')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(self.new_window)
+
+    @staticmethod
+    def new_window():
+        return deque(maxlen=getattr(settings, 'PROFILE_SAMPLES', 1000))
+
+    def add(self, view_name, sample):
+        with self.lock:
+            self.samples[view_name].append(sample)
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+
+    def report(self):
+        with self.lock:
+            windows = {name: list(samples) for name, samples in self.samples.items()}
+
+        report = {}
+        for name, samples in sorted(windows.items()):
+            summary = {"requests": len(samples)}
+            for metric in self.metrics:
+                scale = 1 if metric == 'queries' else 1000
+                ordered = sorted(getattr(sample, metric) * scale for sample in samples)
+                summary[metric] = {
+                    "p50": percentile(ordered, 0.5),
+                    "p95": percentile(ordered, 0.95),
+                    "p99": percentile(ordered, 0.99),
+                    "max": ordered[-1],
+                    "mean": sum(ordered) / len(ordered)
+                }
+            report[name] = summary
+        return report
+
+
+recorder = Recorder()
+
+
+def start_sample():
+    local.sample = Sample()
+    return local.sample
+
+
+def finish_sample():
+    sample = getattr(local, 'sample', None)
+    local.sample = None
+    return sample
+
+
+def current_sample():
+    return getattr(local, 'sample', None)
+
+
+class ProfilingTemplate(Template):
+    def render(self, context=None, request=None):
+        sample = current_sample()
+        if sample is None:
+            return super().render(context, request)
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            sample.template_time += time.perf_counter() - start
+
+
+class ProfilingDjangoTemplates(DjangoTemplates):
+    """
+    Django template backend that adds the render time of top level
+    templates to the sample of the request being profiled.
+    """
+
+    def from_string(self, template_code):
+        return ProfilingTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return ProfilingTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
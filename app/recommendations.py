@@ -0,0 +1,219 @@
+from array import array
+from collections import Counter, defaultdict
+from itertools import accumulate, chain
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import versions
+from .models import Profile, Event, SuggestedEvent, SuggestedProfile
+
+# A shared event counts for half as much as a mutual follow
+CO_PARTICIPATION_WEIGHT = 0.5
+BATCH_SIZE = 500
+
+Following = Profile.following.through
+Participant = Event.participants.through
+
+
+def suggestions_per_profile():
+    return getattr(settings, 'SUGGESTIONS_PER_PROFILE', 10)
+
+
+def zeros(length):
+    return array('q', bytes(8 * length))
+
+
+class Adjacency:
+    """
+    Adjacency lists of (source, target) pairs in compressed sparse row form,
+    the targets of node n are targets[offsets[n]:offsets[n + 1]]. Ids are
+    used as indexes directly, they are dense enough for that.
+    """
+
+    def __init__(self, sources, targets):
+        counts = zeros(max(sources, default=-1) + 2)
+        for source in sources:
+            counts[source + 1] += 1
+        self.offsets = array('q', accumulate(counts))
+        # Counting sort of the targets by source
+        position = self.offsets[:-1]
+        self.targets = zeros(len(targets))
+        for source, target in zip(sources, targets):
+            self.targets[position[source]] = target
+            position[source] += 1
+
+    def __getitem__(self, node):
+        if node + 1 >= len(self.offsets):
+            return ()
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+
+class Graph:
+    """
+    Follows and participations as arrays, no model instances. Given profile
+    ids, only the part of the graph their suggestions depend on is loaded.
+    """
+
+    def __init__(self, profile_ids=None):
+        now = timezone.now()
+        following = Following.objects.all()
+        participants = Participant.objects.all()
+        events = Event.objects.filter(public_flag=True, end_time__gt=now)
+        if profile_ids is not None:
+            friends = Following.objects.filter(from_profile__in=profile_ids).values('to_profile')
+            attended = Participant.objects.filter(profile__in=profile_ids).values('event')
+            following = following.filter(Q(from_profile__in=profile_ids) | Q(from_profile__in=friends))
+            participants = participants.filter(
+                Q(profile__in=profile_ids) | Q(profile__in=friends) | Q(event__in=attended))
+            events = events.filter(pk__in=Participant.objects.filter(profile__in=friends).values('event'))
+
+        self.friends = Adjacency(*self.columns(following.values_list('from_profile_id', 'to_profile_id')))
+        profiles, events_attended = self.columns(participants.values_list('profile_id', 'event_id'))
+        self.attends = Adjacency(profiles, events_attended)
+        self.attendees = Adjacency(events_attended, profiles)
+
+        # Hosts of the events that can still be suggested, 0 for the others
+        upcoming = list(events.values_list('id', 'owner_id').iterator(chunk_size=10000))
+        self.hosts = zeros(max((event_id for event_id, _ in upcoming), default=-1) + 1)
+        for event_id, owner_id in upcoming:
+            self.hosts[event_id] = owner_id
+
+    @staticmethod
+    def columns(pairs):
+        sources, targets = array('q'), array('q')
+        for source, target in pairs.iterator(chunk_size=10000):
+            sources.append(source)
+            targets.append(target)
+        return sources, targets
+
+    def suggested_profiles(self, profile_id, count):
+        friends = self.friends[profile_id]
+        scores = Counter(chain.from_iterable(self.friends[friend] for friend in friends))
+        shared = Counter(chain.from_iterable(self.attendees[event] for event in self.attends[profile_id]))
+        for other, events in shared.items():
+            scores[other] += CO_PARTICIPATION_WEIGHT * events
+        for known in chain(friends, (profile_id,)):
+            scores.pop(known, None)
+        return top(scores, count)
+
+    def suggested_events(self, profile_id, count):
+        scores = Counter(chain.from_iterable(self.attends[friend] for friend in self.friends[profile_id]))
+        for joined in self.attends[profile_id]:
+            scores.pop(joined, None)
+        hosts = self.hosts
+        for event in [event for event in scores if event >= len(hosts) or hosts[event] in (0, profile_id)]:
+            del scores[event]
+        return top(scores, count)
+
+
+def top(scores, count):
+    # sorted() runs in C, a few hundred candidates are cheaper to sort than to push through a heap
+    return sorted(scores.items(), key=itemgetter(1), reverse=True)[:count]
+
+
+def insert(model, columns, rows):
+    # Plain tuples, building millions of model instances would dominate the job
+    sql = 'INSERT INTO {table} ({columns}) VALUES ({values})'.format(
+        table=model._meta.db_table, columns=', '.join(columns), values=', '.join(['%s'] * len(columns)))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+
+
+def stored(model, column, profile_ids):
+    # {profile id: {(suggested id, score), ...}} as currently stored
+    suggestions = defaultdict(set)
+    for profile_id, other, score in model.objects.filter(profile__in=profile_ids) \
+            .values_list('profile_id', column, 'score'):
+        suggestions[profile_id].add((other, score))
+    return suggestions
+
+
+def store(graph, profile_ids):
+    """Writes the suggestions of the given profiles and returns the ids of those whose suggestions changed."""
+    count = suggestions_per_profile()
+    old_profiles = stored(SuggestedProfile, 'suggested_id', profile_ids)
+    old_events = stored(SuggestedEvent, 'event_id', profile_ids)
+    profiles = {profile_id: graph.suggested_profiles(profile_id, count) for profile_id in profile_ids}
+    events = {profile_id: graph.suggested_events(profile_id, count) for profile_id in profile_ids}
+    # Unchanged suggestions are left alone, a full rebuild would otherwise
+    # rewrite every row and invalidate every profile page
+    changed = [profile_id for profile_id in profile_ids if set(profiles[profile_id]) != old_profiles[profile_id]
+               or set(events[profile_id]) != old_events[profile_id]]
+
+    SuggestedProfile.objects.filter(profile__in=changed).delete()
+    SuggestedEvent.objects.filter(profile__in=changed).delete()
+    insert(SuggestedProfile, ('profile_id', 'suggested_id', 'score'), [
+        (profile_id, other, score) for profile_id in changed for other, score in profiles[profile_id]])
+    insert(SuggestedEvent, ('profile_id', 'event_id', 'score'), [
+        (profile_id, event, score) for profile_id in changed for event, score in events[profile_id]])
+    # The suggestions are shown on the profile page, its ETag has to change
+    versions.touch(Profile, *changed)
+    return changed
+
+
+def rebuild():
+    """Recomputes the suggestions of every profile from the whole graph and returns their number."""
+    # Flags are cleared before the graph is read, changes made meanwhile set them again
+    Profile.objects.filter(suggestions_stale=True).update(suggestions_stale=False)
+    graph = Graph()
+    profile_ids = list(Profile.objects.order_by('id').values_list('id', flat=True))
+    for start in range(0, len(profile_ids), BATCH_SIZE):
+        with transaction.atomic():
+            store(graph, profile_ids[start:start + BATCH_SIZE])
+    return len(profile_ids)
+
+
+def refresh(limit=None):
+    """
+    Recomputes the suggestions of stale profiles, at most limit of them,
+    loading only the neighbourhood of each batch. Returns their number.
+    """
+    refreshed = 0
+    while limit is None or refreshed < limit:
+        size = BATCH_SIZE if limit is None else min(BATCH_SIZE, limit - refreshed)
+        profile_ids = list(Profile.objects.filter(suggestions_stale=True).order_by('id')
+                           .values_list('id', flat=True)[:size])
+        if not profile_ids:
+            break
+        # Flags are cleared with the write, a failed batch is picked up again
+        with transaction.atomic():
+            Profile.objects.filter(pk__in=profile_ids).update(suggestions_stale=False)
+            store(Graph(profile_ids), profile_ids)
+        refreshed += len(profile_ids)
+    return refreshed
+
+
+def mark_stale(profiles, events=()):
+    """Flags the given profiles, their followers and the participants of the given events."""
+    Profile.objects.filter(suggestions_stale=False).filter(
+        Q(pk__in=profiles) | Q(pk__in=Following.objects.filter(to_profile__in=profiles).values('from_profile')) |
+        Q(pk__in=Participant.objects.filter(event__in=events).values('profile'))
+    ).update(suggestions_stale=True)
+
+
+@receiver(m2m_changed, sender=Profile.following.through)
+def following_changed(sender, instance, action, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove') and pk_set:
+        mark_stale([instance.pk, *pk_set])
+    elif action == 'pre_clear':
+        mark_stale([instance.pk])
+
+
+@receiver(m2m_changed, sender=Event.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove') and pk_set:
+        if reverse:
+            mark_stale([instance.pk], pk_set)
+        else:
+            mark_stale(pk_set, [instance.pk])
+    elif action == 'pre_clear':
+        if reverse:
+            mark_stale([instance.pk], instance.events_participating.values('pk'))
+        else:
+            mark_stale(instance.participants.values('pk'), [instance.pk])
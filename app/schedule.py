@@ -0,0 +1,180 @@
+from datetime import date, datetime, time, timedelta
+
+from django.core import signing
+from django.db import connection
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Event, EventDay
+
+FEED_SALT = 'app.schedule.feed'
+# Range of the iCalendar feed around now
+FEED_PAST_DAYS = 30
+FEED_FUTURE_DAYS = 365
+# Longest range of the calendar page and API
+CALENDAR_MAX_DAYS = 31
+# Events spanning more UTC days than a valid one can (older rows, bulk
+# inserts) get a single row on this day, every range query includes it
+LONG_EVENT_DAY = date.min
+MAX_INDEXED_DAYS = Event.MAX_DAYS + 1
+
+
+def days(start, end):
+    """
+    UTC dates from the one of start to the one of end, both included, or
+    only LONG_EVENT_DAY when there are more than MAX_INDEXED_DAYS of them.
+    """
+    day = start.astimezone(timezone.utc).date()
+    last = end.astimezone(timezone.utc).date()
+    if (last - day).days >= MAX_INDEXED_DAYS:
+        yield LONG_EVENT_DAY
+        return
+    while day <= last:
+        yield day
+        day += timedelta(days=1)
+
+
+def index_event(event):
+    EventDay.objects.filter(event=event).delete()
+    EventDay.objects.bulk_create([EventDay(event=event, day=day) for day in days(event.start_time, event.end_time)])
+
+
+def rebuild(batch_size=None, chunk_size=2000):
+    """Recreates the day rows of every event and returns how many were written."""
+    EventDay.objects.all().delete()
+    if connection.vendor == 'sqlite':
+        # Stored datetimes are UTC text, date() gives the UTC day directly
+        names = {"day_table": EventDay._meta.db_table, "event_table": Event._meta.db_table,
+                 "long_event": 'julianday(date(end_time)) - julianday(date(start_time)) >= %d' % MAX_INDEXED_DAYS}
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {day_table} (event_id, day) '
+                'WITH RECURSIVE spans(event_id, day, last) AS ('
+                'SELECT id, date(start_time), date(end_time) FROM {event_table} WHERE NOT {long_event} '
+                "UNION ALL SELECT event_id, date(day, '+1 day'), last FROM spans WHERE day < last"
+                ') SELECT event_id, day FROM spans'.format(**names))
+            written = cursor.rowcount
+            cursor.execute('INSERT INTO {day_table} (event_id, day) SELECT id, %s FROM {event_table} '
+                           'WHERE {long_event}'.format(**names), [LONG_EVENT_DAY])
+            return written + cursor.rowcount
+
+    rows, written = [], 0
+    for event_id, start_time, end_time in Event.objects.values_list('id', 'start_time', 'end_time') \
+            .iterator(chunk_size=chunk_size):
+        rows.extend(EventDay(event_id=event_id, day=day) for day in days(start_time, end_time))
+        if len(rows) >= chunk_size:
+            EventDay.objects.bulk_create(rows, batch_size=batch_size)
+            written += len(rows)
+            rows = []
+    EventDay.objects.bulk_create(rows, batch_size=batch_size)
+    return written + len(rows)
+
+
+def visible_to(profile):
+    return Event.objects.filter(Q(public_flag=True) | Q(pk__in=Event.objects.private_for(profile).values('pk')))
+
+
+def attended_by(profile):
+    participating = Event.participants.through.objects.filter(profile=profile).values('event_id')
+    return Event.objects.filter(Q(owner=profile) | Q(pk__in=participating))
+
+
+def overlapping(queryset, start, end, by_day=True):
+    """
+    Events of the queryset that take place at some point between start and
+    end. Candidates come from the day index, pass by_day=False for small
+    querysets (one profile's events) that are cheaper to check directly.
+    """
+    queryset = queryset.filter(start_time__lt=end, end_time__gt=start)
+    if not by_day:
+        return queryset
+    candidates = EventDay.objects.filter(Q(day__range=(start.astimezone(timezone.utc).date(),
+                                                        end.astimezone(timezone.utc).date())) |
+                                         Q(day=LONG_EVENT_DAY))
+    return queryset.filter(pk__in=candidates.values('event_id'))
+
+
+def local_range(first_day, count):
+    """Start and end of count days in the current time zone, starting with first_day."""
+    start = timezone.make_aware(datetime.combine(first_day, time.min))
+    end = timezone.make_aware(datetime.combine(first_day + timedelta(days=count), time.min))
+    return start, end
+
+
+def conflicts(events):
+    """
+    Pairs of overlapping events from a list ordered by start time, found in
+    one sweep that keeps the events still running at each start.
+    """
+    running, pairs = [], []
+    for event in events:
+        running = [other for other in running if other.end_time > event.start_time]
+        pairs.extend((other, event) for other in running)
+        running.append(event)
+    return pairs
+
+
+def feed_token(user):
+    return signing.dumps(user.pk, salt=FEED_SALT)
+
+
+def feed_user_id(token):
+    try:
+        return signing.loads(token, salt=FEED_SALT)
+    except signing.BadSignature:
+        return None
+
+
+def ical_text(value):
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n') \
+        .replace('\n', '\\n')
+
+
+def ical_time(value):
+    return value.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def ical_line(line):
+    # Lines longer than 75 octets are folded, continuation lines start with a space
+    encoded = line.encode()
+    parts = []
+    while len(encoded) > 75:
+        cut = 75 if not parts else 74
+        # Never split a multi byte character
+        while cut > 0 and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode())
+        encoded = encoded[cut:]
+    parts.append(encoded.decode())
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def ical_feed(rows, request):
+    """
+    Yields an iCalendar document line by line for rows of (id, title,
+    description, start_time, end_time), nothing is built in memory.
+    """
+    stamp = ical_time(timezone.now())
+    yield ical_line('BEGIN:VCALENDAR')
+    yield ical_line('VERSION:2.0')
+    yield ical_line('PRODID:-//Recreatus//Events//EN')
+    for event_id, title, description, start_time, end_time in rows:
+        yield ical_line('BEGIN:VEVENT')
+        yield ical_line('UID:event-%d@%s' % (event_id, request.get_host()))
+        yield ical_line('DTSTAMP:' + stamp)
+        yield ical_line('DTSTART:' + ical_time(start_time))
+        yield ical_line('DTEND:' + ical_time(end_time))
+        yield ical_line('SUMMARY:' + ical_text(title))
+        yield ical_line('DESCRIPTION:' + ical_text(description))
+        yield ical_line('URL:' + request.build_absolute_uri(reverse('app:event_detail', args=[event_id])))
+        yield ical_line('END:VEVENT')
+    yield ical_line('END:VCALENDAR')
+
+
+@receiver(post_save, sender=Event)
+def index_saved_event(sender, instance, created, update_fields=None, **kwargs):
+    if created or update_fields is None or {'start_time', 'end_time'} & set(update_fields):
+        index_event(instance)
@@ -0,0 +1,308 @@
+import hashlib
+import re
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.cache import cache
+from django.db import connection, connections
+from django.db.models import Q
+from django.db.models.signals import post_migrate, post_save, post_delete
+from django.dispatch import receiver
+from django.utils.html import escape
+from django.utils.module_loading import import_string
+from django.utils.safestring import mark_safe
+
+from .models import Event
+from .pagination import KeysetPage, KeysetPaginator
+
+CURSOR_SALT = 'app.search.cursor'
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+
+class DatabaseSearchBackend:
+    """
+    Plain substring matching with icontains. Works on every database but
+    scans the whole table, used when no full-text index is available.
+    """
+
+    def is_available(self):
+        return True
+
+    def search_events(self, queryset, query, cursor, per_page):
+        events = queryset.filter(Q(title__icontains=query) | Q(description__icontains=query))
+        return KeysetPaginator(events, per_page).page(cursor)
+
+    def search_users(self, queryset, query, cursor, per_page):
+        users = queryset.filter(username__icontains=query)
+        return KeysetPaginator(users, per_page, ordering=('username', 'id')).page(cursor)
+
+    def create_tables(self, db_connection):
+        pass
+
+    def index_event(self, event):
+        pass
+
+    def index_events(self, events):
+        pass
+
+    def remove_event(self, event_id):
+        pass
+
+    def index_user(self, user):
+        pass
+
+    def remove_user(self, user_id):
+        pass
+
+    def rebuild(self, batch_size=1000):
+        return {}
+
+
+class SQLiteFTSSearchBackend(DatabaseSearchBackend):
+    """
+    Ranked prefix search on SQLite FTS5 tables that mirror the searchable
+    columns. Only public events are indexed. The tables are created by
+    migrate and rebuild_search_index, rows are kept in sync by the signal
+    receivers below.
+    """
+
+    event_table = 'app_event_search'
+    user_table = 'app_user_search'
+    # bm25 column weights, a title hit counts more than a description hit
+    event_weights = (10.0, 1.0)
+    snippet_tokens = 16
+
+    def __init__(self):
+        self.available = None
+
+    def is_available(self):
+        if self.available is None:
+            self.available = self.supports_fts5(connection)
+        return self.available
+
+    @staticmethod
+    def supports_fts5(db_connection):
+        if db_connection.vendor != 'sqlite':
+            return False
+        with db_connection.cursor() as cursor:
+            cursor.execute('PRAGMA compile_options')
+            return any(row[0] == 'ENABLE_FTS5' for row in cursor.fetchall())
+
+    def create_tables(self, db_connection):
+        if not self.supports_fts5(db_connection):
+            return
+        with db_connection.cursor() as cursor:
+            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(title, description, prefix='2 3', "
+                           "tokenize='unicode61 remove_diacritics 2')" % self.event_table)
+            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(username, prefix='2 3', "
+                           "tokenize='unicode61 remove_diacritics 2')" % self.user_table)
+
+    def index_event(self, event):
+        if not event.public_flag:
+            self.remove_event(event.pk)
+            return
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.event_table, [event.pk])
+            cursor.execute('INSERT INTO %s (rowid, title, description) VALUES (%%s, %%s, %%s)' % self.event_table,
+                           [event.pk, event.title, event.description])
+
+    def index_events(self, events):
+        # Bulk inserts send no post_save, the importer indexes its chunks with this
+        rows = [(event.pk, event.title, event.description) for event in events if event.public_flag]
+        with connection.cursor() as cursor:
+            cursor.executemany('DELETE FROM %s WHERE rowid = %%s' % self.event_table, [row[:1] for row in rows])
+            cursor.executemany('INSERT INTO %s (rowid, title, description) VALUES (%%s, %%s, %%s)' % self.event_table,
+                               rows)
+
+    def remove_event(self, event_id):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.event_table, [event_id])
+
+    def index_user(self, user):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.user_table, [user.pk])
+            cursor.execute('INSERT INTO %s (rowid, username) VALUES (%%s, %%s)' % self.user_table,
+                           [user.pk, user.username])
+
+    def remove_user(self, user_id):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.user_table, [user_id])
+
+    def rebuild(self, batch_size=1000):
+        sources = [
+            (self.event_table, '(rowid, title, description) VALUES (%s, %s, %s)',
+             Event.objects.filter(public_flag=True).values_list('id', 'title', 'description')),
+            (self.user_table, '(rowid, username) VALUES (%s, %s)',
+             User.objects.values_list('id', 'username')),
+        ]
+        counts = {}
+        self.create_tables(connection)
+        with connection.cursor() as cursor:
+            for table, insert, rows in sources:
+                cursor.execute('DELETE FROM %s' % table)
+                counts[table] = 0
+                batch = []
+                for row in rows.iterator(chunk_size=batch_size):
+                    batch.append(row)
+                    if len(batch) == batch_size:
+                        cursor.executemany('INSERT INTO %s %s' % (table, insert), batch)
+                        counts[table] += len(batch)
+                        batch = []
+                if batch:
+                    cursor.executemany('INSERT INTO %s %s' % (table, insert), batch)
+                    counts[table] += len(batch)
+                cursor.execute("INSERT INTO %s (%s) VALUES ('optimize')" % (table, table))
+        return counts
+
+    def search_events(self, queryset, query, cursor, per_page):
+        if not self.is_available():
+            return super().search_events(queryset, query, cursor, per_page)
+        weights = ', '.join(str(weight) for weight in self.event_weights)
+        # Titles are rendered anyway, the snippet is cut from the description
+        return self._search(queryset, query, cursor, per_page, self.event_table, 'bm25(%s, %s)' % (
+            self.event_table, weights), snippet_column=1)
+
+    def search_users(self, queryset, query, cursor, per_page):
+        if not self.is_available():
+            return super().search_users(queryset, query, cursor, per_page)
+        return self._search(queryset, query, cursor, per_page, self.user_table, 'bm25(%s)' % self.user_table,
+                            snippet_column=0)
+
+    @staticmethod
+    def match_expression(query):
+        # Every word becomes a quoted prefix term, so user input can never
+        # be parsed as FTS5 syntax
+        terms = re.findall(r'\w+', query)
+        return ' '.join('"%s"*' % term for term in terms)
+
+    def _search(self, queryset, query, cursor, per_page, table, rank, snippet_column):
+        match = self.match_expression(query)
+        if not match:
+            return KeysetPage([])
+
+        direction, after = self._decode(cursor)
+        backwards = direction == 'prev'
+        sql = 'SELECT rowid, %s AS search_rank FROM %s WHERE %s MATCH %%s' % (rank, table, table)
+        params = [match]
+        if after is not None:
+            lookup = '<' if backwards else '>'
+            sql += ' AND (%s %s %%s OR (%s = %%s AND rowid %s %%s))' % (rank, lookup, rank, lookup)
+            params += [after[0], after[0], after[1]]
+        order = 'DESC' if backwards else 'ASC'
+        sql += ' ORDER BY search_rank %s, rowid %s LIMIT %%s' % (order, order)
+        params.append(per_page + 1)
+
+        with connection.cursor() as db_cursor:
+            db_cursor.execute(sql, params)
+            hits = db_cursor.fetchall()
+        has_more = len(hits) > per_page
+        hits = hits[:per_page]
+        if backwards:
+            hits.reverse()
+
+        next_cursor = previous_cursor = None
+        if hits:
+            if has_more or backwards:
+                next_cursor = self._encode('next', hits[-1])
+            if after is not None and (has_more or not backwards):
+                previous_cursor = self._encode('prev', hits[0])
+
+        ids = [hit[0] for hit in hits]
+        snippets = self._snippets(table, snippet_column, match, ids)
+        objects = queryset.in_bulk(ids)
+        object_list = []
+        for pk in ids:
+            if pk in objects:
+                obj = objects[pk]
+                obj.search_snippet = snippets.get(pk)
+                object_list.append(obj)
+        return KeysetPage(object_list, next_cursor, previous_cursor, self._count(table, match))
+
+    def _snippets(self, table, column, match, ids):
+        if not ids:
+            return {}
+        sql = 'SELECT rowid, snippet(%s, %d, %%s, %%s, %%s, %%s) FROM %s WHERE %s MATCH %%s AND rowid IN (%s)' % (
+            table, column, table, table, ', '.join(['%s'] * len(ids)))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [HIGHLIGHT_START, HIGHLIGHT_END, '…', self.snippet_tokens, match] + ids)
+            rows = cursor.fetchall()
+        return {
+            pk: mark_safe(escape(snippet).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>'))
+            for pk, snippet in rows
+        }
+
+    def _count(self, table, match):
+        timeout = getattr(settings, 'FEED_COUNT_CACHE_TIMEOUT', None)
+        if not timeout:
+            return None
+        key = 'search-count:%s:%s' % (table, hashlib.md5(match.encode()).hexdigest())
+        count = cache.get(key)
+        if count is None:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT COUNT(*) FROM %s WHERE %s MATCH %%s' % (table, table), [match])
+                count = cursor.fetchone()[0]
+            cache.set(key, count, timeout)
+        return count
+
+    @staticmethod
+    def _encode(direction, hit):
+        return signing.dumps([direction, hit[1], hit[0]], salt=CURSOR_SALT, compress=True)
+
+    @staticmethod
+    def _decode(cursor):
+        if not cursor:
+            return 'next', None
+        try:
+            direction, rank, pk = signing.loads(cursor, salt=CURSOR_SALT)
+            after = (float(rank), int(pk))
+        except (signing.BadSignature, ValueError, TypeError):
+            return 'next', None
+        if direction not in ('next', 'prev'):
+            return 'next', None
+        return direction, after
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        backend = import_string(getattr(settings, 'SEARCH_BACKEND', 'app.search.DatabaseSearchBackend'))()
+        _backend = backend if backend.is_available() else DatabaseSearchBackend()
+    return _backend
+
+
+@receiver(post_migrate)
+def create_search_tables(sender, using, **kwargs):
+    # The app has no migrations, "migrate --run-syncdb" and test databases
+    # get the tables from here
+    if sender.label != 'app':
+        return
+    backend = import_string(getattr(settings, 'SEARCH_BACKEND', 'app.search.DatabaseSearchBackend'))()
+    backend.create_tables(connections[using])
+
+
+@receiver(post_save, sender=Event)
+def index_event(sender, instance, **kwargs):
+    get_backend().index_event(instance)
+
+
+@receiver(post_delete, sender=Event)
+def remove_event(sender, instance, **kwargs):
+    get_backend().remove_event(instance.pk)
+
+
+@receiver(post_save, sender=User)
+def index_user(sender, instance, update_fields=None, **kwargs):
+    # Logging in saves last_login only, no need to touch the index then
+    if update_fields is not None and 'username' not in update_fields:
+        return
+    get_backend().index_user(instance)
+
+
+@receiver(post_delete, sender=User)
+def remove_user(sender, instance, **kwargs):
+    get_backend().remove_user(instance.pk)
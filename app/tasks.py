@@ -0,0 +1,127 @@
+import json
+import logging
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import timeline
+from .models import Profile, Event, Task
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+
+def task(function):
+    """Registers a function that can be enqueued by its name."""
+    registry[function.__name__] = function
+    return function
+
+
+def enqueue(function, *args, idempotency_key=None, delay=0, max_attempts=3):
+    """
+    Queues function(*args) for a worker and returns the Task. Arguments must
+    be JSON serializable. With an idempotency key, enqueueing the same work
+    twice returns the existing task. With TASKS_ALWAYS_EAGER the task runs
+    right away instead, which keeps development setups worker free.
+    """
+    name = function.__name__
+    if name not in registry:
+        raise ValueError('%s is not a registered task' % name)
+
+    fields = {
+        "name": name,
+        "arguments": json.dumps(list(args)),
+        "run_after": timezone.now() + timedelta(seconds=delay),
+        "max_attempts": max_attempts
+    }
+    if idempotency_key is not None:
+        try:
+            with transaction.atomic():
+                queued, created = Task.objects.get_or_create(idempotency_key=idempotency_key, defaults=fields)
+        except IntegrityError:
+            return Task.objects.get(idempotency_key=idempotency_key)
+        if not created:
+            return queued
+    else:
+        queued = Task.objects.create(**fields)
+
+    if getattr(settings, 'TASKS_ALWAYS_EAGER', False) and claim(queued.pk):
+        execute(queued.pk)
+        queued.refresh_from_db()
+    return queued
+
+
+def claim(task_id):
+    # The conditional UPDATE makes sure only one worker runs a task
+    return Task.objects.filter(pk=task_id, status=Task.PENDING).update(
+        status=Task.RUNNING, locked_at=timezone.now(), attempts=F('attempts') + 1) == 1
+
+
+def execute(task_id):
+    queued = Task.objects.get(pk=task_id)
+    try:
+        function = registry[queued.name]
+        with transaction.atomic():
+            function(*json.loads(queued.arguments))
+    except Exception:
+        error = traceback.format_exc()
+        logger.exception('Task %s failed on attempt %d', queued, queued.attempts)
+        if queued.attempts < queued.max_attempts:
+            # Exponential backoff, 2, 4, 8... seconds
+            Task.objects.filter(pk=task_id).update(
+                status=Task.PENDING, locked_at=None, last_error=error,
+                run_after=timezone.now() + timedelta(seconds=2 ** queued.attempts))
+        else:
+            Task.objects.filter(pk=task_id).update(status=Task.FAILED, locked_at=None, last_error=error)
+        return False
+    Task.objects.filter(pk=task_id).update(status=Task.DONE, locked_at=None)
+    return True
+
+
+def due_tasks(limit):
+    return list(Task.objects.filter(status=Task.PENDING, run_after__lte=timezone.now())
+                .order_by('run_after', 'id').values_list('id', flat=True)[:limit])
+
+
+def release_stale(timeout):
+    """Puts tasks of workers that died while running them back in the queue."""
+    return Task.objects.filter(status=Task.RUNNING, locked_at__lt=timezone.now() - timedelta(seconds=timeout)) \
+        .update(status=Task.PENDING, locked_at=None)
+
+
+@task
+def fan_out_event(event_id):
+    event = Event.objects.filter(pk=event_id).first()
+    if event is not None:
+        timeline.fan_out(event)
+
+
+@task
+def update_follow_timelines(profile_id, followed_id):
+    """
+    Brings the follower's timeline in line with the follow state at the time
+    the task runs, so follow and unfollow tasks of a pair can finish in any
+    order.
+    """
+    # Tasks of the same follower wait for each other, the state is read once the row is locked
+    profile = Profile.objects.select_for_update().filter(pk=profile_id).first()
+    followed = Profile.objects.filter(pk=followed_id).first()
+    if profile is None or followed is None:
+        return
+    if Profile.following.through.objects.filter(from_profile=profile_id, to_profile=followed_id).exists():
+        timeline.follow(profile, followed)
+    else:
+        timeline.unfollow(profile, followed)
+
+
+@task
+def invite_users(event_id, user_ids):
+    event = Event.objects.filter(pk=event_id).first()
+    if event is not None:
+        invited, skipped = event.invite(user_ids)
+        logger.info('Invited %d users to event %d, skipped %d', invited, event_id, skipped)
@@ -0,0 +1,34 @@
+from django import template
+
+from app import caching
+
+register = template.Library()
+
+
+class CacheFragmentNode(template.Node):
+    def __init__(self, nodelist, obj, name, vary_on):
+        self.nodelist = nodelist
+        self.obj = obj
+        self.name = name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        vary_on = [value.resolve(context) for value in self.vary_on]
+        return caching.cached_fragment(self.obj.resolve(context), self.name.resolve(context), vary_on,
+                                       lambda: self.nodelist.render(context))
+
+
+@register.tag('cachefragment')
+def do_cachefragment(parser, token):
+    """
+    Caches the enclosed block per Event or Profile until its version changes.
+
+    Usage: {% cachefragment event 'row' [vary_on ...] %} ... {% endcachefragment %}
+    """
+    nodelist = parser.parse(('endcachefragment',))
+    parser.delete_first_token()
+    bits = token.split_contents()
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError("'%s' tag requires an object and a fragment name" % bits[0])
+    return CacheFragmentNode(nodelist, *[parser.compile_filter(bit) for bit in bits[1:3]],
+                             [parser.compile_filter(bit) for bit in bits[3:]])
@@ -1,3 +1,976 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.db.utils import ConnectionHandler
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import caching, datagen, profiling, recommendations, schedule, tasks, timeline, transfer, trending
+from .forms import CreateEventForm
+from .presence import PresenceTracker
+from .search import DatabaseSearchBackend, SQLiteFTSSearchBackend
+from .models import Comment, Evaluation, Event, EventDay, Profile, Task, TimelineEntry, TrendingScore
+from .pagination import KeysetPaginator
+
+
+def create_event(owner, title='Event', **kwargs):
+    now = timezone.now()
+    fields = {
+        "title": title,
+        "description": "Description",
+        "start_time": now + timedelta(days=1),
+        "end_time": now + timedelta(days=2),
+        "owner": owner
+    }
+    fields.update(kwargs)
+    return Event.objects.create(**fields)
+
+
+class EventListingQueryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('host', password='password')
+        self.guests = [User.objects.create_user('guest%d' % i, password='password').profile for i in range(3)]
+        self.client.login(username='host', password='password')
+
+    def add_events(self, count):
+        for i in range(count):
+            event = create_event(self.user.profile, title='Event %d' % i)
+            event.participants.add(*self.guests)
+
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_for_listing_is_a_single_query(self):
+        self.add_events(3)
+        with self.assertNumQueries(1):
+            rows = [(event.owner.user.username, event.participant_count) for event in Event.objects.for_listing()]
+        self.assertEqual(rows, [('host', 3)] * 3)
+
+    def test_listing_query_count_does_not_grow_with_events(self):
+        urls = [
+            reverse('app:index'),
+            reverse('app:private_events'),
+            reverse('app:search') + '?query=Event&type=events',
+            reverse('app:user_detail', args=[self.user.id])
+        ]
+        self.add_events(1)
+        baseline = [self.count_queries(url) for url in urls]
+        self.add_events(4)
+        self.assertEqual([self.count_queries(url) for url in urls], baseline)
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user('host').profile
+        start = timezone.now()
+        # Two events share a start time, the id breaks the tie
+        for i in range(5):
+            create_event(owner, title='Event %d' % i, start_time=start + timedelta(hours=min(i, 3)))
+        self.paginator = KeysetPaginator(Event.objects.all(), 2, count_timeout=0)
+
+    def titles(self, page):
+        return [event.title for event in page]
+
+    def test_pages_follow_each_other_without_offset(self):
+        first = self.paginator.page()
+        with CaptureQueriesContext(connection) as context:
+            second = self.paginator.page(first.next_cursor)
+        third = self.paginator.page(second.next_cursor)
+        self.assertNotIn('OFFSET', context[0]['sql'])
+        self.assertEqual([self.titles(first), self.titles(second), self.titles(third)],
+                         [['Event 4', 'Event 3'], ['Event 2', 'Event 1'], ['Event 0']])
+        self.assertFalse(first.has_previous())
+        self.assertFalse(third.has_next())
+        self.assertEqual(self.titles(self.paginator.page(third.previous_cursor)), ['Event 2', 'Event 1'])
+
+    def test_tampered_cursor_starts_over(self):
+        cursor = self.paginator.page().next_cursor
+        self.assertEqual(self.titles(self.paginator.page(cursor[:-1] + 'x')), ['Event 4', 'Event 3'])
+
+
+class GenerateDataTest(TestCase):
+    def test_follows_are_directed_and_counters_consistent(self):
+        counts = datagen.generate(users=30, events_per_user=2, follows_per_user=5)
+        Following = Profile.following.through
+        follows = set(Following.objects.values_list('from_profile_id', 'to_profile_id'))
+        self.assertEqual(len(follows), counts['follows'])
+        mutual = sum((b, a) in follows for a, b in follows)
+        self.assertGreater(mutual, 0)
+        self.assertLess(mutual, len(follows))
+
+        event = Event.objects.order_by('id').first()
+        self.assertEqual((event.participant_count, event.comment_count),
+                         (event.participants.count(), event.comments.count()))
+
+
+class EventDetailQueryTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('host', password='password')
+        self.event = create_event(self.user.profile)
+        self.client.login(username='host', password='password')
+
+    def add_guests(self, count):
+        start = self.event.participants.count()
+        for i in range(start, start + count):
+            profile = User.objects.create_user('guest%d' % i).profile
+            self.user.profile.following.add(profile)
+            self.event.participants.add(profile)
+            Comment.objects.create(content='Comment %d' % i, owner=profile, event=self.event)
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('app:event_detail', args=[self.event.id]))
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_query_count_does_not_grow_with_participants_and_comments(self):
+        self.add_guests(1)
+        baseline = self.count_queries()
+        self.add_guests(5)
+        self.assertEqual(self.count_queries(), baseline)
+
+    def test_viewing_does_not_change_following(self):
+        self.add_guests(2)
+        self.event.invited_users.add(*self.user.profile.following.all())
+        self.count_queries()
+        self.assertEqual(self.user.profile.following.count(), 2)
+
+
+class RatingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.host = User.objects.create_user('host', password='password')
+        self.graders = [User.objects.create_user('guest%d' % i).profile for i in range(2)]
+        self.event = create_event(self.host.profile)
+
+    def test_totals_follow_evaluations(self):
+        evaluations = [Evaluation.objects.create(grade=grade, grader=grader, event=self.event)
+                       for grade, grader in zip((4, 9), self.graders)]
+        self.host.profile.refresh_from_db()
+        self.assertEqual((self.host.profile.rating_sum, self.host.profile.rating_count), (13, 2))
+        self.assertEqual(self.host.profile.rating, 6.5)
+
+        evaluations[1].delete()
+        self.host.profile.refresh_from_db()
+        self.assertEqual(self.host.profile.rating, 4)
+
+        self.client.login(username='host', password='password')
+        response = self.client.get(reverse('app:user_detail', args=[self.host.id]))
+        self.assertEqual(response.context['rating'], 4)
+
+    def test_saving_a_stale_profile_keeps_the_totals(self):
+        stale = Profile.objects.get(pk=self.host.profile.pk)
+        Evaluation.objects.create(grade=8, grader=self.graders[0], event=self.event)
+        stale.bio = 'Host'
+        stale.save()
+        # Logging in saves the user, which saves its profile
+        self.client.login(username='host', password='password')
+        profile = Profile.objects.get(pk=stale.pk)
+        self.assertEqual((profile.bio, profile.rating_sum, profile.rating_count), ('Host', 8, 1))
+
+    def test_backfill_recomputes_totals(self):
+        Evaluation.objects.create(grade=7, grader=self.graders[0], event=self.event)
+        Profile.objects.update(rating_sum=100, rating_count=1)
+        versions = dict(Profile.objects.values_list('pk', 'version'))
+        call_command('backfill_ratings', stdout=io.StringIO())
+        self.host.profile.refresh_from_db()
+        self.assertEqual((self.host.profile.rating_sum, self.host.profile.rating_count), (7, 1))
+        self.assertEqual(Profile.objects.get(pk=self.graders[0].pk).rating_count, 0)
+        # Every total changed, the pages of all three profiles are stale
+        self.assertTrue(all(version > versions[pk] for pk, version in Profile.objects.values_list('pk', 'version')))
+
+        versions = dict(Profile.objects.values_list('pk', 'version'))
+        call_command('backfill_ratings', stdout=io.StringIO())
+        self.assertEqual(dict(Profile.objects.values_list('pk', 'version')), versions)
+
+
+@override_settings(LAST_ONLINE_STALENESS=60, LAST_ONLINE_FLUSH_INTERVAL=3600)
+class PresenceTest(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user('user%d' % i) for i in range(2)]
+        self.tracker = PresenceTracker()
+
+    def last_online(self, user):
+        return Profile.objects.get(user=user).last_online
+
+    def test_touches_are_coalesced_until_stale(self):
+        for _ in range(3):
+            self.tracker.touch(self.users[0].id)
+        self.tracker.touch(self.users[1].id)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.tracker.flush(), 2)
+        self.assertEqual(self.last_online(self.users[0]), self.tracker.written[self.users[0].id])
+
+        # Written within the staleness window, nothing to write
+        self.tracker.touch(self.users[0].id)
+        self.assertEqual(self.tracker.flush(), 0)
+        self.assertEqual(self.tracker.stats(), {"touches": 5, "writes": 2, "coalesced": 3, "pending": 0,
+                                                "flushes": 1})
+
+        self.tracker.written[self.users[0].id] -= timedelta(seconds=61)
+        self.tracker.touch(self.users[0].id)
+        self.assertEqual(self.tracker.flush(), 1)
+
+    def test_flush_forgets_stamps_past_the_staleness_window(self):
+        self.tracker.touch(self.users[0].id)
+        self.tracker.flush()
+        self.tracker.written[self.users[0].id] -= timedelta(seconds=61)
+        self.tracker.touch(self.users[1].id)
+        self.tracker.flush()
+        self.assertEqual(list(self.tracker.written), [self.users[1].id])
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        owner = User.objects.create_user('host').profile
+        create_event(owner, title='Board games night', description='Bring snacks')
+        create_event(owner, title='Picnic', description='Board games and a football')
+        create_event(owner, title='Private board meeting', public_flag=False)
+        User.objects.create_user('boardgamer')
+        self.backend = SQLiteFTSSearchBackend()
+        if not self.backend.is_available():
+            self.skipTest('SQLite is built without FTS5')
+
+    def titles(self, page):
+        return [event.title for event in page]
+
+    def test_prefix_matches_ranked_by_title_first(self):
+        page = self.backend.search_events(Event.objects.filter(public_flag=True), 'boa gam', '', 10)
+        self.assertEqual(self.titles(page), ['Board games night', 'Picnic'])
+        self.assertEqual(page.object_list[1].search_snippet,
+                         '<mark>Board</mark> <mark>games</mark> and a football')
+
+    def test_pages_and_users(self):
+        first = self.backend.search_events(Event.objects.all(), 'board', '', 1)
+        second = self.backend.search_events(Event.objects.all(), 'board', first.next_cursor, 1)
+        self.assertEqual(self.titles(first) + self.titles(second), ['Board games night', 'Picnic'])
+        self.assertFalse(second.has_next())
+        users = self.backend.search_users(User.objects.all(), 'board', '', 10)
+        self.assertEqual([user.username for user in users], ['boardgamer'])
+
+    def test_fts_syntax_in_queries_is_matched_literally(self):
+        self.assertEqual(self.titles(self.backend.search_events(Event.objects.all(), 'picnic" -*', '', 10)),
+                         ['Picnic'])
+        self.assertEqual(len(self.backend.search_events(Event.objects.all(), '"*', '', 10)), 0)
+
+    def test_index_follows_event_changes(self):
+        event = Event.objects.get(title='Picnic')
+        event.public_flag = False
+        event.save()
+        self.assertEqual(self.titles(self.backend.search_events(Event.objects.all(), 'football', '', 10)), [])
+
+    def test_substring_fallback(self):
+        page = DatabaseSearchBackend().search_events(Event.objects.filter(public_flag=True), 'games', '', 10)
+        self.assertEqual(sorted(self.titles(page)), ['Board games night', 'Picnic'])
+
+
+class InviteTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.host = User.objects.create_user('host', password='password')
+        self.guests = [User.objects.create_user('guest%d' % i) for i in range(4)]
+        self.event = create_event(self.host.profile, public_flag=False)
+        self.event.invited_users.add(self.guests[0].profile)
+
+    def invited(self):
+        return set(self.event.invited_users.values_list('user__username', flat=True))
+
+    def test_invalid_unknown_and_repeated_ids_are_skipped(self):
+        user_ids = [str(self.guests[0].id), str(self.guests[1].id), self.guests[1].id, self.guests[2].id,
+                    'abc', None, 999999]
+        self.assertEqual(self.event.invite(user_ids), (2, 5))
+        self.assertEqual(self.invited(), {'guest0', 'guest1', 'guest2'})
+        self.assertEqual(self.event.invite([self.guests[1].id]), (0, 1))
+
+    def test_query_count_per_batch(self):
+        # Profiles, existing invitations, the insert and the version touches of the receivers
+        with CaptureQueriesContext(connection) as small:
+            self.event.invite([self.guests[1].id])
+        with CaptureQueriesContext(connection) as large:
+            self.event.invite([guest.id for guest in self.guests])
+        self.assertEqual(len(large), len(small))
+
+    def test_invited_guest_sees_the_private_event(self):
+        self.client.login(username='host', password='password')
+        self.client.post(reverse('app:invite_users', args=[self.event.id]),
+                         {'invited_users': [self.guests[3].id]})
+        self.assertIn('guest3', self.invited())
+        self.assertIn(self.event, Event.objects.private_for(self.guests[3].profile))
+
+
+class FragmentCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_user('host', password='password')
+        self.event = create_event(User.objects.get(username='host').profile, title='Picnic')
+        self.client.login(username='host', password='password')
+
+    def get_index(self):
+        before = caching.stats()
+        response = self.client.get(reverse('app:index'))
+        after = caching.stats()
+        return response, after['hits'] - before['hits'], after['misses'] - before['misses']
+
+    def test_rows_are_reused_until_the_event_changes(self):
+        response, hits, misses = self.get_index()
+        self.assertContains(response, 'Picnic')
+        self.assertEqual((hits, misses), (0, 1))
+        self.assertEqual(self.get_index()[1:], (1, 0))
+
+        self.event.title = 'Barbecue'
+        self.event.save()
+        response, hits, misses = self.get_index()
+        self.assertContains(response, 'Barbecue')
+        self.assertEqual((hits, misses), (0, 1))
+
+    def test_saving_a_stale_instance_never_reuses_an_older_version(self):
+        stale = Event.objects.get(pk=self.event.pk)
+        self.event.title = 'Barbecue'
+        self.event.save()
+        self.assertContains(self.get_index()[0], 'Barbecue')
+
+        stale.title = 'Fair'
+        stale.save()
+        stale.refresh_from_db()
+        self.assertEqual(stale.version, 3)
+        self.assertContains(self.get_index()[0], 'Fair')
+
+    def test_new_comments_invalidate_the_event_page(self):
+        url = reverse('app:event_detail', args=[self.event.id])
+        self.client.get(url)
+        Comment.objects.create(content='See you there', owner=self.event.owner, event=self.event)
+        self.assertContains(self.client.get(url), 'See you there')
+
+    def test_renamed_users_are_shown_under_their_new_name(self):
+        guest = User.objects.create_user('guest')
+        self.event.participants.add(guest.profile)
+        Comment.objects.create(content='Hi', owner=guest.profile, event=self.event)
+        self.event.owner.following.add(guest.profile)
+        urls = [reverse('app:index'), reverse('app:event_detail', args=[self.event.id]),
+                reverse('app:user_detail', args=[self.event.owner.user_id])]
+        for url in urls:
+            self.client.get(url)
+
+        for user, name in ((User.objects.get(username='host'), 'renamed-host'), (guest, 'renamed-guest')):
+            user.username = name
+            user.save()
+        self.assertContains(self.client.get(urls[0]), 'Hosted by: renamed-host')
+        for url in urls[1:]:
+            response = self.client.get(url)
+            self.assertContains(response, '>renamed-guest</a>')
+            self.assertNotContains(response, '>guest</a>')
+
+
+class ConditionalPageTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('host')
+        self.event = create_event(self.user.profile)
+        self.client.force_login(self.user)
+        self.url = reverse('app:event_detail', args=[self.event.id])
+
+    def revisit(self, response):
+        return self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'],
+                               HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+
+    def test_unchanged_pages_are_answered_with_304(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        not_modified = self.revisit(response)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+
+        Comment.objects.create(content='Hi', owner=self.user.profile, event=self.event)
+        changed = self.revisit(response)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+
+    def test_versions_are_not_offered_in_the_admin(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get(reverse('admin:app_event_change', args=[self.event.pk]))
+        self.assertContains(response, 'name="title"')
+        self.assertNotContains(response, 'name="version"')
+        self.assertNotContains(response, 'name="updated_at_0"')
+
+    def test_pages_differ_per_viewer(self):
+        response = self.client.get(self.url)
+        self.client.force_login(User.objects.create_user('guest'))
+        self.assertEqual(self.revisit(response).status_code, 200)
+
+    def test_profile_page_changes_with_listed_events(self):
+        self.url = reverse('app:user_detail', args=[self.user.id])
+        response = self.client.get(self.url)
+        self.assertEqual(self.revisit(response).status_code, 304)
+        self.event.participants.add(User.objects.create_user('guest').profile)
+        self.assertEqual(self.revisit(response).status_code, 200)
+
+
+@override_settings(PROFILE_REQUESTS=True)
+class ProfilingTest(TestCase):
+    def setUp(self):
+        profiling.recorder.reset()
+        User.objects.create_user('staff', password='password', is_staff=True)
+        self.client.login(username='staff', password='password')
+
+    def test_samples_are_filed_per_view(self):
+        counts = []
+        for _ in range(2):
+            with CaptureQueriesContext(connection) as context:
+                self.client.get(reverse('app:index'))
+            counts.append(len(context))
+        report = self.client.get(reverse('app:profiling_report')).json()
+        self.assertEqual(report['app:index']['requests'], 2)
+        self.assertEqual(report['app:index']['queries']['max'], max(counts))
+        self.assertGreater(report['app:index']['template_time']['p50'], 0)
+
+        self.client.post(reverse('app:profiling_report'))
+        # The reset request itself is recorded after the reset
+        self.assertEqual(list(profiling.recorder.report()), ['app:profiling_report'])
+
+
+@override_settings(TASKS_ALWAYS_EAGER=True, TIMELINE_FANOUT_LIMIT=2)
+class TimelineTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = {name: User.objects.create_user(name) for name in ('alice', 'bob', 'carol', 'dave')}
+        self.events = {name: create_event(user.profile, title='%s event' % name) for name, user in self.users.items()}
+
+    def follow(self, name, other, follow=True):
+        self.client.force_login(self.users[name])
+        self.client.get(reverse('app:follow_user', args=[self.users[other].id]),
+                        {'follow': 'true' if follow else 'false'})
+
+    def timeline(self, name):
+        return [event.title for event in timeline.page(self.users[name].profile, '', 10)]
+
+    def test_follow_fills_only_the_followers_timeline(self):
+        self.follow('bob', 'alice')
+        self.assertEqual(self.timeline('bob'), ['alice event'])
+        self.assertEqual(self.timeline('alice'), [])
+
+    def test_unfollow_keeps_the_other_direction(self):
+        self.follow('alice', 'bob')
+        self.follow('bob', 'alice')
+        self.follow('alice', 'bob', follow=False)
+        self.assertEqual(self.timeline('alice'), [])
+        self.assertEqual(self.timeline('bob'), ['alice event'])
+
+    def test_new_events_are_pushed_to_followers(self):
+        self.follow('bob', 'alice')
+        self.client.force_login(self.users['alice'])
+        now = timezone.now()
+        self.client.post(reverse('app:create_event'), {
+            'title': 'Later', 'description': 'Description', 'public_flag': True,
+            'start_time': (now + timedelta(days=3)).strftime('%Y-%m-%d %H:%M:%S'),
+            'end_time': (now + timedelta(days=4)).strftime('%Y-%m-%d %H:%M:%S')})
+        self.assertEqual(self.timeline('bob'), ['Later', 'alice event'])
+        self.assertEqual(self.timeline('carol'), [])
+
+    def test_events_made_private_leave_the_timeline(self):
+        self.follow('bob', 'alice')
+        self.assertEqual(self.timeline('bob'), ['alice event'])
+        event = self.events['alice']
+        event.public_flag = False
+        event.save()
+        self.assertEqual(self.timeline('bob'), [])
+
+    def test_events_of_popular_profiles_are_pulled(self):
+        for name in ('bob', 'carol', 'dave'):
+            self.follow(name, 'alice')
+        timeline.fan_out(create_event(self.users['alice'].profile, title='Popular'))
+        self.assertTrue(Profile.objects.get(user__username='alice').fanout_on_read)
+        self.assertFalse(TimelineEntry.objects.filter(event__title='Popular').exists())
+        self.assertEqual(self.timeline('bob'), ['Popular', 'alice event'])
+
+        # Followed after the last pull, the older events still come along
+        Profile.objects.filter(user__username='carol').update(fanout_on_read=True)
+        self.follow('bob', 'carol')
+        self.assertEqual(self.timeline('bob'), ['Popular', 'carol event', 'alice event'])
+
+
+@tasks.task
+def failing_task():
+    raise RuntimeError('Failed')
+
+
+class TaskQueueTest(TestCase):
+    def test_a_task_is_claimed_once(self):
+        queued = tasks.enqueue(failing_task)
+        self.assertEqual(tasks.due_tasks(10), [queued.pk])
+        self.assertTrue(tasks.claim(queued.pk))
+        self.assertFalse(tasks.claim(queued.pk))
+        self.assertEqual(tasks.due_tasks(10), [])
+
+    def test_failed_tasks_are_retried_with_backoff(self):
+        queued = tasks.enqueue(failing_task, max_attempts=2)
+        with self.assertLogs('app.tasks', 'ERROR'):
+            tasks.claim(queued.pk)
+            self.assertFalse(tasks.execute(queued.pk))
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Task.PENDING, 1))
+        self.assertIn('RuntimeError', queued.last_error)
+        self.assertGreater(queued.run_after, timezone.now())
+
+        Task.objects.filter(pk=queued.pk).update(run_after=timezone.now())
+        with self.assertLogs('app.tasks', 'ERROR'):
+            tasks.claim(queued.pk)
+            tasks.execute(queued.pk)
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Task.FAILED, 2))
+
+    def test_abandoned_tasks_are_released(self):
+        running, recent = tasks.enqueue(failing_task), tasks.enqueue(failing_task)
+        tasks.claim(running.pk)
+        tasks.claim(recent.pk)
+        Task.objects.filter(pk=running.pk).update(locked_at=timezone.now() - timedelta(seconds=600))
+        self.assertEqual(tasks.release_stale(300), 1)
+        self.assertEqual(tasks.due_tasks(10), [running.pk])
+
+    def test_idempotency_key_queues_once(self):
+        first = tasks.enqueue(failing_task, idempotency_key='once')
+        self.assertEqual(tasks.enqueue(failing_task, idempotency_key='once').pk, first.pk)
+
+    def test_follow_task_reads_the_current_follow_state(self):
+        alice, bob = [User.objects.create_user(name).profile for name in ('alice', 'bob')]
+        create_event(bob)
+        alice.following.add(bob)
+        follow = tasks.enqueue(tasks.update_follow_timelines, alice.pk, bob.pk)
+        alice.following.remove(bob)
+        unfollow = tasks.enqueue(tasks.update_follow_timelines, alice.pk, bob.pk)
+        # The unfollow finishes first
+        for queued in (unfollow, follow):
+            tasks.claim(queued.pk)
+            self.assertTrue(tasks.execute(queued.pk))
+        self.assertFalse(TimelineEntry.objects.filter(profile=alice).exists())
+
+
+class EventCounterTest(TestCase):
+    def setUp(self):
+        self.host, self.guest, self.other = [User.objects.create_user(name).profile
+                                             for name in ('host', 'guest', 'other')]
+        self.events = [create_event(self.host) for _ in range(2)]
+
+    def counts(self, event):
+        event.refresh_from_db()
+        return event.participant_count, event.comment_count
+
+    def test_participants_in_both_directions(self):
+        self.events[0].participants.add(self.guest, self.other)
+        self.events[0].participants.add(self.guest)
+        self.guest.events_participating.add(*self.events)
+        self.assertEqual([self.counts(event) for event in self.events], [(2, 0), (1, 0)])
+
+        self.guest.events_participating.remove(self.events[1])
+        self.events[0].participants.remove(self.other)
+        self.assertEqual([self.counts(event) for event in self.events], [(1, 0), (0, 0)])
+        self.events[0].participants.clear()
+        self.assertEqual(self.counts(self.events[0]), (0, 0))
+
+    def test_comments_and_deleted_profiles(self):
+        comments = [Comment.objects.create(content='Hi', owner=self.guest, event=self.events[0]) for _ in range(2)]
+        self.events[0].participants.add(self.guest, self.other)
+        comments[0].delete()
+        self.assertEqual(self.counts(self.events[0]), (2, 1))
+        self.other.user.delete()
+        self.assertEqual(self.counts(self.events[0]), (1, 1))
+
+    def test_saves_of_stale_instances_keep_the_counters(self):
+        stale = Event.objects.get(pk=self.events[0].pk)
+        self.events[0].participants.add(self.guest)
+        Comment.objects.create(content='Hi', owner=self.guest, event=self.events[0])
+        stale.title = 'Renamed'
+        stale.save()
+        self.assertEqual(self.counts(stale), (1, 1))
+        self.assertEqual(stale.title, 'Renamed')
+
+        # The admin form offers no inputs for them
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get(reverse('admin:app_event_change', args=[stale.pk]))
+        self.assertContains(response, 'name="title"')
+        self.assertNotContains(response, 'name="participant_count"')
+        self.assertNotContains(response, 'name="comment_count"')
+
+    def test_reconcile_repairs_drift(self):
+        self.events[0].participants.add(self.guest)
+        Event.objects.filter(pk=self.events[1].pk).update(participant_count=5, comment_count=3)
+        output = io.StringIO()
+        call_command('reconcile_counters', stdout=output)
+        self.assertIn('Repaired 1 events', output.getvalue())
+        self.assertEqual([self.counts(event) for event in self.events], [(1, 0), (0, 0)])
+
+
+class TrendingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('host')
+        self.guests = [User.objects.create_user('guest%d' % i).profile for i in range(3)]
+        self.busy, self.quiet, self.private = [create_event(self.user.profile, title=title, public_flag=public)
+                                               for title, public in (('Busy', True), ('Quiet', True),
+                                                                     ('Private', False))]
+        self.busy.participants.add(*self.guests)
+        self.quiet.participants.add(self.guests[0])
+        self.private.participants.add(*self.guests)
+
+    def scores(self):
+        return dict(TrendingScore.objects.values_list('event__title', 'score'))
+
+    def test_incremental_scores_match_a_rebuild(self):
+        Comment.objects.create(content='Hi', owner=self.guests[0], event=self.quiet)
+        incremental = self.scores()
+        self.assertEqual(trending.rebuild(), 2)
+        rebuilt = self.scores()
+        self.assertEqual(set(rebuilt), {'Busy', 'Quiet'})
+        for title, score in rebuilt.items():
+            self.assertAlmostEqual(incremental[title], score, places=3)
+
+    def test_feed_orders_by_score_and_drops_private_events(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('app:trending'))
+        self.assertEqual([event.title for event in response.context['events_page']], ['Busy', 'Quiet'])
+
+        self.busy.public_flag = False
+        self.busy.save()
+        self.quiet.participants.add(*self.guests[1:])
+        response = self.client.get(reverse('app:trending'))
+        self.assertEqual([event.title for event in response.context['events_page']], ['Quiet'])
+        self.assertEqual(set(self.scores()), {'Quiet'})
+
+
+class ApiTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('host')
+        self.guest = User.objects.create_user('guest')
+        now = timezone.now()
+        for i in range(3):
+            create_event(self.user.profile, title='Event %d' % i, start_time=now + timedelta(days=i + 1),
+                         end_time=now + timedelta(days=i + 1, hours=2))
+        self.private = create_event(self.user.profile, title='Private', public_flag=False)
+        self.client.force_login(self.guest)
+
+    def get(self, name, *args, **params):
+        return self.client.get(reverse(name, args=args), params)
+
+    def test_authentication_is_required(self):
+        self.client.logout()
+        self.assertEqual(self.get('app:api_events').status_code, 401)
+
+    def test_fields_and_cursor_pages(self):
+        first = self.get('app:api_events', fields='title,owner_username', limit=2).json()
+        self.assertEqual(first['results'], [{"title": "Event 2", "owner_username": "host"},
+                                            {"title": "Event 1", "owner_username": "host"}])
+        second = self.get('app:api_events', fields='title', limit=2, cursor=first['next']).json()
+        self.assertEqual(second['results'], [{"title": "Event 0"}])
+        self.assertIsNone(second['next'])
+        back = self.get('app:api_events', fields='title', limit=2, cursor=second['previous']).json()
+        self.assertEqual([row['title'] for row in back['results']], ['Event 2', 'Event 1'])
+        # Cursors that do not verify start over
+        self.assertEqual(self.get('app:api_events', fields='title', limit=2, cursor='bogus').json()['results'],
+                         [{"title": "Event 2"}, {"title": "Event 1"}])
+
+    def test_bad_parameters_are_answered_with_400(self):
+        response = self.get('app:api_events', fields='title,password')
+        self.assertEqual((response.status_code, response.json()), (400, {"error": "Unknown fields: password"}))
+        for start, end in (('tomorrow', '2030-01-02'), ('2030-02-30', '2030-03-02'), ('2030-01-01', '2030-06-01')):
+            self.assertEqual(self.get('app:api_calendar', start=start, end=end).status_code, 400)
+
+    def test_private_events_are_hidden(self):
+        self.assertEqual(self.get('app:api_event', self.private.id).status_code, 404)
+        self.assertEqual(self.get('app:api_event_comments', self.private.id).status_code, 404)
+        self.private.invited_users.add(self.guest.profile)
+        self.assertEqual(self.get('app:api_event', self.private.id, fields='title').json(), {"title": "Private"})
+
+    def test_unchanged_responses_are_not_sent_again(self):
+        response = self.get('app:api_profile', self.user.id)
+        self.assertEqual(response.json()['username'], 'host')
+        repeated = self.client.get(reverse('app:api_profile', args=[self.user.id]),
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(repeated.status_code, 304)
+
+    def test_export_streams_public_events(self):
+        response = self.get('app:api_export_events', fields='id,title')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['title'] for line in lines], ['Event 0', 'Event 1', 'Event 2'])
+
+
+class CalendarTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('host')
+        self.guest = User.objects.create_user('guest')
+        self.start = datetime(2030, 1, 1, 22, tzinfo=timezone.utc)
+        self.event = create_event(self.user.profile, title='Festival', start_time=self.start,
+                                  end_time=self.start + timedelta(days=2))
+        self.client.force_login(self.guest)
+
+    def indexed_days(self):
+        return sorted(EventDay.objects.values_list('event__title', 'day'))
+
+    def form(self, start_time, end_time):
+        return CreateEventForm({"title": "Event", "description": "Description", "public_flag": True,
+                                "start_time": start_time, "end_time": end_time})
+
+    def test_events_end_after_they_start_and_within_the_longest_span(self):
+        self.assertTrue(self.form('2030-01-01 10:00', '2030-01-01 12:00').is_valid())
+        for end_time in ('2030-01-01 10:00', '2029-12-31 10:00', '2031-06-01 10:00'):
+            self.assertIn('end_time', self.form('2030-01-01 10:00', end_time).errors)
+        with self.assertRaises(ValidationError):
+            Event(title='Long', description='', start_time=self.start, owner=self.user.profile,
+                  end_time=self.start + timedelta(days=Event.MAX_DAYS + 1)).full_clean()
+
+    def test_day_index_follows_saves_and_rebuilds(self):
+        self.assertEqual(self.indexed_days(), [('Festival', date(2030, 1, d)) for d in (1, 2, 3)])
+        self.event.end_time = self.start + timedelta(hours=3)
+        self.event.save(update_fields=['end_time'])
+        self.assertEqual(self.indexed_days(), [('Festival', date(2030, 1, 1)), ('Festival', date(2030, 1, 2))])
+        # Spans no valid event has are indexed on one day, not one row per day
+        long = create_event(self.user.profile, title='Exhibition', start_time=self.start,
+                            end_time=self.start + timedelta(days=10 * Event.MAX_DAYS))
+        self.assertEqual(list(EventDay.objects.filter(event=long).values_list('day', flat=True)),
+                         [schedule.LONG_EVENT_DAY])
+        indexed = self.indexed_days()
+        self.assertEqual(schedule.rebuild(), len(indexed))
+        self.assertEqual(self.indexed_days(), indexed)
+
+        start = datetime(2035, 3, 1, tzinfo=timezone.utc)
+        found = schedule.overlapping(Event.objects.all(), start, start + timedelta(days=1))
+        self.assertEqual([event.title for event in found], ['Exhibition'])
+
+    def test_calendar_lists_events_on_the_days_they_span(self):
+        response = self.client.get(reverse('app:calendar'), {'start': '2029-12-31', 'days': 4})
+        titles = [[event.title for event in events] for _, events in response.context['days']]
+        self.assertEqual(titles, [[], ['Festival'], ['Festival'], ['Festival']])
+        response = self.client.get(reverse('app:calendar'), {'start': '2029-12-31', 'days': 1000})
+        self.assertEqual(response.context['count'], schedule.CALENDAR_MAX_DAYS)
+
+    def test_own_calendar_and_feed_show_attended_events(self):
+        self.event.participants.add(self.guest.profile)
+        create_event(self.guest.profile, title='Rehearsal', start_time=self.start + timedelta(hours=1),
+                     end_time=self.start + timedelta(hours=3))
+        response = self.client.get(reverse('app:calendar'), {'start': '2030-01-01', 'scope': 'mine'})
+        self.assertEqual([(first.title, second.title) for first, second in response.context['conflicts']],
+                         [('Festival', 'Rehearsal')])
+
+        self.event.start_time = timezone.now() + timedelta(days=1)
+        self.event.end_time = self.event.start_time + timedelta(hours=2)
+        self.event.save()
+        self.client.logout()
+        response = self.client.get(reverse('app:calendar_feed', args=[schedule.feed_token(self.guest)]))
+        self.assertIn('SUMMARY:Festival', b''.join(response.streaming_content).decode())
+        self.assertTemplateUsed(self.client.get(reverse('app:calendar_feed', args=['bogus'])), 'errors/error404.html')
+
+
+class CommentPageTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('host', password='password')
+        self.event = create_event(self.user.profile)
+        self.client.login(username='host', password='password')
+        now = timezone.now()
+        for i in range(25):
+            Comment.objects.create(content='Comment %d' % i, owner=self.user.profile, event=self.event,
+                                   posted_on=now - timedelta(minutes=25 - i))
+
+    def test_newest_comments_first_and_older_ones_on_request(self):
+        page = self.client.get(reverse('app:event_detail', args=[self.event.id])).context['comments_page']
+        self.assertEqual([comment.content for comment in page][:2], ['Comment 24', 'Comment 23'])
+        self.assertEqual(len(page), 20)
+
+        response = self.client.get(reverse('app:comments', args=[self.event.id]), {'cursor': page.next_cursor})
+        self.assertEqual([comment.content for comment in response.context['comments_page']],
+                         ['Comment %d' % i for i in range(4, -1, -1)])
+        self.assertNotContains(response, 'data-load-more')
+
+        response = self.client.get(reverse('app:comments', args=[self.event.id]),
+                                   {'cursor': page.next_cursor, 'format': 'json'})
+        self.assertEqual(len(response.json()['results']), 5)
+
+
+class RecommendationTest(TestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol, self.dave = [User.objects.create_user(name).profile
+                                                       for name in ('alice', 'bob', 'carol', 'dave')]
+        self.alice.following.add(self.bob)
+        self.bob.following.add(self.carol)
+        self.event = create_event(self.dave)
+        self.event.participants.add(self.bob, self.dave)
+
+    def suggestions(self, profile):
+        return ([suggestion.suggested for suggestion in profile.suggested_profiles.order_by('-score')],
+                [suggestion.event for suggestion in profile.suggested_events.order_by('-score')])
+
+    def test_friends_of_friends_and_their_events(self):
+        self.assertEqual(recommendations.refresh(), 4)
+        self.assertEqual(self.suggestions(self.alice), ([self.carol], [self.event]))
+        # dave only shares an event with bob
+        self.assertEqual(self.suggestions(self.dave), ([self.bob], []))
+
+    def test_changes_mark_the_neighbourhood_stale(self):
+        recommendations.refresh()
+        self.carol.following.add(self.dave)
+        stale = set(Profile.objects.filter(suggestions_stale=True).values_list('user__username', flat=True))
+        self.assertEqual(stale, {'bob', 'carol', 'dave'})
+        self.assertEqual(recommendations.refresh(), 3)
+        self.assertEqual(self.suggestions(self.bob)[0], [self.dave])
+
+    def test_failed_refresh_keeps_the_profiles_stale(self):
+        with mock.patch.object(recommendations, 'store', side_effect=RuntimeError('Failed')):
+            with self.assertRaises(RuntimeError):
+                recommendations.refresh()
+        self.assertEqual(Profile.objects.filter(suggestions_stale=True).count(), 4)
+        self.assertEqual(recommendations.refresh(), 4)
+
+    def test_only_changed_suggestions_touch_the_profile(self):
+        recommendations.rebuild()
+        versions = dict(Profile.objects.values_list('pk', 'version'))
+        recommendations.rebuild()
+        self.assertEqual(dict(Profile.objects.values_list('pk', 'version')), versions)
+
+        self.carol.following.add(self.dave)
+        versions = dict(Profile.objects.values_list('pk', 'version'))
+        recommendations.rebuild()
+        touched = {pk for pk, version in Profile.objects.values_list('pk', 'version') if version > versions[pk]}
+        # bob is suggested dave and carol the event dave attends, alice and dave keep theirs
+        self.assertEqual(touched, {self.bob.pk, self.carol.pk})
+
+
+class TransferTest(TestCase):
+    def setUp(self):
+        host, guest = [User.objects.create_user(name).profile for name in ('host', 'guest')]
+        self.event = create_event(host, end_time=timezone.now() - timedelta(hours=1),
+                                  start_time=timezone.now() - timedelta(hours=2))
+        self.event.participants.add(guest)
+        Comment.objects.create(content='See you', owner=guest, event=self.event)
+        Evaluation.objects.create(grader=guest, event=self.event, grade=8)
+
+    def round_trip(self, file_format):
+        path = os.path.join(tempfile.mkdtemp(), 'events.%s' % file_format)
+        call_command('export_events', path, stderr=io.StringIO())
+        with open(path, 'a') as file:
+            file.write('{"title": "No times", "owner": "host"}\n' if file_format == 'jsonl' else
+                       'No times,Description,,,true,host,,,[],[]\n')
+        errors = io.StringIO()
+        call_command('import_events', path, stdout=io.StringIO(), stderr=errors)
+        self.assertIn('start_time', errors.getvalue())
+
+        imported = Event.objects.exclude(pk=self.event.pk).get()
+        self.assertEqual((imported.title, imported.start_time, imported.end_time),
+                         (self.event.title, self.event.start_time.replace(microsecond=0),
+                          self.event.end_time.replace(microsecond=0)))
+        self.assertEqual((imported.participant_count, imported.comment_count), (1, 1))
+        self.assertEqual(list(imported.participants.values_list('user__username', flat=True)), ['guest'])
+        self.assertEqual(Evaluation.objects.get(event=imported).grade, 8)
+        self.assertEqual(Profile.objects.get(user__username='host').rating_count, 2)
+
+    def test_jsonl_round_trip(self):
+        self.round_trip('jsonl')
+
+    def test_grades_follow_the_rules_of_rate_event(self):
+        record = {"title": "Rated", "description": "Description", "start_time": '2020-01-01 10:00:00',
+                  "end_time": '2020-01-01 12:00:00', "public": True, "owner": 'host', "participants": ['guest']}
+        rejected = [
+            dict(record, evaluations=[{"grader": 'host', "grade": 5}]),
+            dict(record, participants=[], evaluations=[{"grader": 'guest', "grade": 5}]),
+            dict(record, end_time='2099-01-01 12:00:00', evaluations=[{"grader": 'guest', "grade": 5}]),
+        ]
+        accepted = dict(record, evaluations=[{"grader": 'guest', "grade": 5}])
+        rows, errors = transfer.validate([(number, json.dumps(raw)) for number, raw in
+                                          enumerate(rejected + [accepted], 1)])
+        self.assertEqual([row.grades for row in rows], [{Profile.objects.get(user__username='guest').pk: 5}])
+        self.assertEqual([number for number, _ in errors], [1, 2, 3])
+
+    def test_csv_round_trip(self):
+        self.round_trip('csv')
+
+
+class DatabaseProfileTest(TestCase):
+    def test_production_connections_apply_the_pragmas(self):
+        profile = dict(settings.DATABASE_PROFILES['production'], NAME=os.path.join(tempfile.mkdtemp(), 'db.sqlite3'))
+        production = ConnectionHandler({"default": profile})['default']
+        try:
+            with production.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                journal_mode = cursor.fetchone()[0]
+                cursor.execute('PRAGMA busy_timeout')
+                busy_timeout = cursor.fetchone()[0]
+        finally:
+            production.close()
+        self.assertEqual(journal_mode.upper(), profile['PRAGMAS']['journal_mode'])
+        self.assertEqual(busy_timeout, profile['PRAGMAS']['busy_timeout'])
+
+
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cached_db')
+class SessionQueryTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_user('host', password='password')
+        self.client.login(username='host', password='password')
+
+    def test_user_and_profile_come_in_one_query(self):
+        self.client.get(reverse('app:private_events'))
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(reverse('app:private_events'))
+        # The user with its profile, then the events
+        self.assertEqual(len(context), 2)
+        self.assertIn('app_profile', context[0]['sql'])
+
+    def test_expired_sessions_are_deleted_in_batches(self):
+        expired = timezone.now() - timedelta(days=1)
+        Session.objects.bulk_create([Session(session_key='expired%d' % i, session_data='', expire_date=expired)
+                                     for i in range(5)])
+        output = io.StringIO()
+        call_command('clear_expired_sessions', batch_size=2, stdout=output)
+        self.assertIn('Deleted 5', output.getvalue())
+        self.assertEqual(Session.objects.count(), 1)
+
+
+class IndexUsageTest(TestCase):
+    def setUp(self):
+        self.profile = User.objects.create_user('host').profile
+        self.event = create_event(self.profile)
+
+    def assertUsesIndex(self, queryset, index_name):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Query plans are only checked on SQLite')
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+
+    def test_public_feed_uses_partial_index(self):
+        queryset = Event.objects.filter(public_flag=True).order_by('-start_time', '-id')[:3]
+        self.assertUsesIndex(queryset, 'event_public_feed_idx')
+
+    def test_hosted_events_use_owner_index(self):
+        self.assertUsesIndex(Event.objects.filter(owner=self.profile).order_by('-start_time'),
+                             'event_owner_start_idx')
+
+    def test_end_time_checks_use_index(self):
+        self.assertUsesIndex(Event.objects.filter(end_time__gt=timezone.now()), 'event_end_time_idx')
+
+    def test_event_comments_use_index(self):
+        self.assertUsesIndex(self.event.comments.order_by('posted_on', 'id'), 'comment_event_posted_idx')
+
+    def test_evaluation_lookup_uses_unique_index(self):
+        queryset = Evaluation.objects.filter(grader=self.profile, event=self.event)
+        self.assertUsesIndex(queryset, '(grader_id=? AND event_id=?)')
+
+    def test_evaluation_is_unique_per_grader_and_event(self):
+        Evaluation.objects.create(grade=5, grader=self.profile, event=self.event)
+        with self.assertRaises(IntegrityError):
+            Evaluation.objects.create(grade=7, grader=self.profile, event=self.event)
@@ -0,0 +1,125 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+
+from .models import Profile, Event, TimelineEntry
+from .pagination import KeysetPage, KeysetPaginator
+
+TRIM_BATCH = 500
+
+
+def timeline_length():
+    return getattr(settings, 'TIMELINE_LENGTH', 500)
+
+
+def fanout_limit():
+    return getattr(settings, 'TIMELINE_FANOUT_LIMIT', 1000)
+
+
+def followers_of(profile_id):
+    return Profile.objects.filter(following=profile_id)
+
+
+def fan_out(event):
+    """
+    Pushes a new public event to the timelines of everyone following its
+    owner. Owners with more than TIMELINE_FANOUT_LIMIT followers are
+    switched to fan-out on read instead, see pull().
+    """
+    if not event.public_flag:
+        return 0
+    follower_ids = list(followers_of(event.owner_id).values_list('id', flat=True)[:fanout_limit() + 1])
+    if len(follower_ids) > fanout_limit():
+        Profile.objects.filter(pk=event.owner_id, fanout_on_read=False).update(fanout_on_read=True)
+        return 0
+    TimelineEntry.objects.bulk_create([
+        TimelineEntry(profile_id=profile_id, event_id=event.pk, start_time=event.start_time)
+        for profile_id in follower_ids
+    ], ignore_conflicts=True)
+    trim(follower_ids)
+    return len(follower_ids)
+
+
+def follow(profile, followed):
+    # following is directed, only the follower's timeline gets the other's events
+    if followed.fanout_on_read:
+        # The next pull() copies the events
+        cache.delete(pulled_key(profile.pk, followed.pk))
+    else:
+        backfill(profile.pk, followed.pk)
+
+
+def unfollow(profile, followed):
+    TimelineEntry.objects.filter(profile=profile, event__owner=followed).delete()
+    cache.delete(pulled_key(profile.pk, followed.pk))
+
+
+def backfill(reader_id, author_id):
+    events = Event.objects.filter(owner_id=author_id, public_flag=True).order_by('-start_time', '-id')
+    TimelineEntry.objects.bulk_create([
+        TimelineEntry(profile_id=reader_id, event_id=event_id, start_time=start_time)
+        for event_id, start_time in events.values_list('id', 'start_time')[:timeline_length()]
+    ], ignore_conflicts=True)
+    trim([reader_id])
+
+
+def trim(profile_ids):
+    """Deletes everything past the newest TIMELINE_LENGTH entries of the given timelines."""
+    table = TimelineEntry._meta.db_table
+    with connection.cursor() as cursor:
+        for start in range(0, len(profile_ids), TRIM_BATCH):
+            batch = profile_ids[start:start + TRIM_BATCH]
+            cursor.execute(
+                'DELETE FROM {table} WHERE id IN (SELECT id FROM ('
+                'SELECT id, ROW_NUMBER() OVER (PARTITION BY profile_id ORDER BY start_time DESC, event_id DESC) '
+                'AS position FROM {table} WHERE profile_id IN ({ids})) ranked WHERE position > %s)'.format(
+                    table=table, ids=', '.join(['%s'] * len(batch))),
+                batch + [timeline_length()])
+
+
+def pulled_key(reader_id, author_id):
+    return 'timeline-pulled:%s:%s' % (reader_id, author_id)
+
+
+def pull(profile):
+    """
+    Copies events of followed fan-out-on-read profiles that are newer than
+    the last pull of each into the reader's timeline, so reading stays a
+    single ordered scan of TimelineEntry. An author without a high-water
+    mark, e.g. one followed since the last pull, has their latest events
+    copied.
+    """
+    authors = list(Profile.objects.filter(followers=profile, fanout_on_read=True).values_list('id', flat=True))
+    if not authors:
+        return
+    keys = {author_id: pulled_key(profile.pk, author_id) for author_id in authors}
+    marks = cache.get_many(keys.values())
+    condition = Q()
+    for author_id, key in keys.items():
+        condition |= Q(owner_id=author_id, id__gt=marks.get(key, 0))
+    events = list(Event.objects.filter(condition, public_flag=True)
+                  .order_by('-id').values_list('id', 'owner_id', 'start_time')[:timeline_length()])
+    if not events:
+        return
+    TimelineEntry.objects.bulk_create([
+        TimelineEntry(profile_id=profile.pk, event_id=event_id, start_time=start_time)
+        for event_id, _, start_time in events
+    ], ignore_conflicts=True)
+    trim([profile.pk])
+    # Newest first, the first event of each author is their new mark
+    new_marks = {}
+    for event_id, owner_id, _ in events:
+        new_marks.setdefault(keys[owner_id], event_id)
+    cache.set_many(new_marks, None)
+
+
+def page(profile, cursor, per_page):
+    pull(profile)
+    entries = KeysetPaginator(TimelineEntry.objects.filter(profile=profile), per_page,
+                              ordering=('-start_time', '-event'), count_timeout=0).page(cursor)
+    event_ids = [entry.event_id for entry in entries]
+    # Entries of events made private after the fan-out stay behind, they are skipped here
+    events = Event.objects.for_listing().filter(public_flag=True).in_bulk(event_ids)
+    object_list = [events[event_id] for event_id in event_ids if event_id in events]
+    return KeysetPage(object_list, entries.next_cursor, entries.previous_cursor)
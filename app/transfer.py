@@ -0,0 +1,329 @@
+import csv
+import json
+from collections import defaultdict
+from itertools import islice
+
+from django.db import reset_queries, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import recommendations, schedule, versions
+from .forms import CreateEventForm
+from .models import Profile, Event, Comment, Evaluation, EventDay
+from .search import get_backend as search_backend
+
+COLUMNS = ('title', 'description', 'start_time', 'end_time', 'public', 'owner', 'participants', 'invited',
+           'comments', 'evaluations')
+# One of the input formats of CreateEventForm, times are written in UTC
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+CHUNK_SIZE = 1000
+# Usernames per lookup query
+LOOKUP_BATCH = 500
+
+Participant = Event.participants.through
+Invitation = Event.invited_users.through
+
+
+def file_format(path, default='jsonl'):
+    if path and path.endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def format_time(value):
+    return value.astimezone(timezone.utc).strftime(TIME_FORMAT)
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def grouped(rows):
+    # {event_id: [rest of the row, ...]} of (event_id, ...) rows
+    groups = defaultdict(list)
+    for event_id, *rest in rows:
+        groups[event_id].append(rest)
+    return groups
+
+
+def export_records(queryset, chunk_size=CHUNK_SIZE):
+    """
+    Yields one record per event of the queryset. Events are read with
+    iterator(), their participants, invitations, comments and evaluations
+    with one query each per chunk of events.
+    """
+    rows = queryset.order_by('id').values_list(
+        'id', 'title', 'description', 'start_time', 'end_time', 'public_flag', 'owner__user__username')
+    for chunk in chunks(rows.iterator(chunk_size=chunk_size), chunk_size):
+        ids = [row[0] for row in chunk]
+        participants = grouped(Participant.objects.filter(event_id__in=ids)
+                               .values_list('event_id', 'profile__user__username'))
+        invited = grouped(Invitation.objects.filter(event_id__in=ids)
+                          .values_list('event_id', 'profile__user__username'))
+        comments = grouped(Comment.objects.filter(event_id__in=ids).order_by('posted_on', 'id')
+                           .values_list('event_id', 'owner__user__username', 'content', 'posted_on'))
+        evaluations = grouped(Evaluation.objects.filter(event_id__in=ids)
+                              .values_list('event_id', 'grader__user__username', 'grade'))
+        for event_id, title, description, start_time, end_time, public_flag, owner in chunk:
+            yield {
+                "title": title,
+                "description": description,
+                "start_time": format_time(start_time),
+                "end_time": format_time(end_time),
+                "public": public_flag,
+                "owner": owner,
+                "participants": [username for username, in participants[event_id]],
+                "invited": [username for username, in invited[event_id]],
+                "comments": [{"author": author, "content": content, "posted_on": format_time(posted_on)}
+                             for author, content, posted_on in comments[event_id]],
+                "evaluations": [{"grader": grader, "grade": grade} for grader, grade in evaluations[event_id]]
+            }
+
+
+def write_records(records, file, file_format):
+    """Writes records as CSV or JSON Lines and returns the number of rows they stand for."""
+    writer = csv.writer(file) if file_format == 'csv' else None
+    if writer:
+        writer.writerow(COLUMNS)
+    rows = 0
+    for record in records:
+        if writer:
+            writer.writerow(encode_csv(record))
+        else:
+            file.write(json.dumps(record) + '\n')
+        rows += 1 + sum(len(record[name]) for name in ('participants', 'invited', 'comments', 'evaluations'))
+    return rows
+
+
+def encode_csv(record):
+    # Usernames cannot contain spaces, comments and evaluations are JSON
+    return [
+        record['title'], record['description'], record['start_time'], record['end_time'],
+        'true' if record['public'] else 'false', record['owner'], ' '.join(record['participants']),
+        ' '.join(record['invited']), json.dumps(record['comments']), json.dumps(record['evaluations'])
+    ]
+
+
+def read_records(file, file_format):
+    """Yields (line number, raw record) pairs, decoding is left to the importer so errors stay per record."""
+    if file_format == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for number, line in enumerate(file, 1):
+            if line.strip():
+                yield number, line
+
+
+def decode(raw):
+    if isinstance(raw, str):
+        record = json.loads(raw)
+        if not isinstance(record, dict):
+            raise ValueError('Expected a JSON object')
+        return record
+    record = dict(raw)
+    for name in ('participants', 'invited'):
+        record[name] = (record.get(name) or '').split()
+    for name in ('comments', 'evaluations'):
+        record[name] = json.loads(record.get(name) or '[]')
+    return record
+
+
+def usernames(record):
+    names = {record.get('owner')}
+    names.update(record.get('participants') or ())
+    names.update(record.get('invited') or ())
+    names.update(comment.get('author') for comment in record.get('comments') or ())
+    names.update(evaluation.get('grader') for evaluation in record.get('evaluations') or ())
+    return {str(name) for name in names if name is not None}
+
+
+def profile_ids(names):
+    names = sorted(names)
+    ids = {}
+    for start in range(0, len(names), LOOKUP_BATCH):
+        ids.update(Profile.objects.filter(user__username__in=names[start:start + LOOKUP_BATCH])
+                   .values_list('user__username', 'id'))
+    return ids
+
+
+class Row:
+    """A validated record, the Event is unsaved until the chunk is written."""
+
+    def __init__(self, event, participants, invited, comments, grades):
+        self.event = event
+        self.participants = participants
+        self.invited = invited
+        self.comments = comments
+        self.grades = grades
+
+
+def clean(record, profiles):
+    """Validates a decoded record like create_event does and returns its Row, raises ValueError otherwise."""
+    form = CreateEventForm({
+        "title": record.get('title'),
+        "description": record.get('description'),
+        "start_time": record.get('start_time'),
+        "end_time": record.get('end_time'),
+        "public_flag": record.get('public')
+    })
+    # The form reads naive times in the current time zone, files are in UTC
+    with timezone.override(timezone.utc):
+        valid = form.is_valid()
+    if not valid:
+        raise ValueError('; '.join('%s: %s' % (field, ' '.join(errors)) for field, errors in form.errors.items()))
+
+    def profile(username):
+        try:
+            return profiles[str(username)]
+        except KeyError:
+            raise ValueError('Unknown user %r' % username)
+
+    event = form.instance
+    event.owner_id = profile(record.get('owner'))
+    participants = {profile(username) for username in record.get('participants') or ()}
+    invited = {profile(username) for username in record.get('invited') or ()}
+
+    comments = []
+    for comment in record.get('comments') or ():
+        if not comment.get('content'):
+            raise ValueError('Comments need content')
+        posted_on = comment.get('posted_on')
+        posted_on = parse_datetime(str(posted_on)) if posted_on else timezone.now()
+        if posted_on is None:
+            raise ValueError('Invalid comment time %r' % comment.get('posted_on'))
+        if timezone.is_naive(posted_on):
+            posted_on = timezone.make_aware(posted_on, timezone.utc)
+        comments.append(Comment(content=comment['content'], owner_id=profile(comment.get('author')),
+                                posted_on=posted_on))
+
+    # The same range RateForm accepts and the same graders rate_event lets
+    # rate, one grade per grader
+    grades = {}
+    for evaluation in record.get('evaluations') or ():
+        grade = evaluation.get('grade')
+        if not isinstance(grade, int) or not 1 <= grade <= 10:
+            raise ValueError('Grades are whole numbers from 1 to 10, not %r' % grade)
+        grader = profile(evaluation.get('grader'))
+        if grader not in participants:
+            raise ValueError('%s did not take part and cannot rate the event' % evaluation.get('grader'))
+        if grader == event.owner_id:
+            raise ValueError('Hosts cannot rate their own events')
+        grades[grader] = grade
+    if grades and event.end_time > timezone.now():
+        raise ValueError('Events can only be rated once they have ended')
+
+    event.participant_count = len(participants)
+    event.comment_count = len(comments)
+    return Row(event, participants, invited, comments, grades)
+
+
+def validate(chunk):
+    """Returns the Rows of the valid records of a chunk and (line number, message) of the others."""
+    decoded, errors = [], []
+    for number, raw in chunk:
+        try:
+            record = decode(raw)
+            decoded.append((number, record, usernames(record)))
+        except (ValueError, TypeError, AttributeError) as error:
+            errors.append((number, str(error)))
+
+    profiles = profile_ids(set().union(*(names for _, _, names in decoded)))
+    rows = []
+    for number, record, _ in decoded:
+        try:
+            rows.append(clean(record, profiles))
+        except (ValueError, TypeError, AttributeError) as error:
+            errors.append((number, str(error)))
+    return rows, errors
+
+
+def add_ratings(rows, batch_size=None):
+    # Hosts are read and written back in batches instead of one UPDATE per host
+    grades = defaultdict(list)
+    for row in rows:
+        grades[row.event.owner_id].extend(row.grades.values())
+    owner_ids = sorted(owner_id for owner_id, given in grades.items() if given)
+    for start in range(0, len(owner_ids), LOOKUP_BATCH):
+        hosts = list(Profile.objects.select_for_update().filter(pk__in=owner_ids[start:start + LOOKUP_BATCH])
+                     .only('rating_sum', 'rating_count'))
+        for host in hosts:
+            host.rating_sum += sum(grades[host.pk])
+            host.rating_count += len(grades[host.pk])
+        Profile.objects.bulk_update(hosts, ['rating_sum', 'rating_count'], batch_size=batch_size)
+
+
+def store(rows, batch_size=None):
+    """
+    Writes the Rows with bulk inserts and keeps up what the signals of
+    single inserts would: calendar days, search index, host ratings, page
+    versions and suggestions. Returns the number of rows written per model.
+    """
+    events = [row.event for row in rows]
+    Event.objects.bulk_create(events, batch_size=batch_size)
+    if events and events[0].pk is None:
+        # Not every database returns the ids of bulk inserts. On SQLite the
+        # insert holds the write lock until the chunk commits, nothing can be
+        # written after it and the newest events are the ones just inserted
+        newest = list(Event.objects.order_by('-id').values_list('id', 'owner_id', 'title')[:len(events)])[::-1]
+        if [(owner_id, title) for _, owner_id, title in newest] != [(event.owner_id, event.title) for event in events]:
+            raise RuntimeError('Could not match the ids of the inserted events')
+        for event, (pk, _, _) in zip(events, newest):
+            event.pk = pk
+
+    participants = [Participant(event_id=row.event.pk, profile_id=profile_id)
+                    for row in rows for profile_id in row.participants]
+    invitations = [Invitation(event_id=row.event.pk, profile_id=profile_id)
+                   for row in rows for profile_id in row.invited]
+    comments = [comment for row in rows for comment in row.comments]
+    for row in rows:
+        for comment in row.comments:
+            comment.event_id = row.event.pk
+    evaluations = [Evaluation(event_id=row.event.pk, grader_id=grader_id, grade=grade)
+                   for row in rows for grader_id, grade in row.grades.items()]
+    Participant.objects.bulk_create(participants, batch_size=batch_size)
+    Invitation.objects.bulk_create(invitations, batch_size=batch_size)
+    Comment.objects.bulk_create(comments, batch_size=batch_size)
+    Evaluation.objects.bulk_create(evaluations, batch_size=batch_size)
+
+    EventDay.objects.bulk_create([EventDay(event_id=event.pk, day=day) for event in events
+                                  for day in schedule.days(event.start_time, event.end_time)], batch_size=batch_size)
+    search_backend().index_events(events)
+    add_ratings(rows, batch_size)
+    # Hosts, participants and guests list the new events on their pages
+    members = sorted({event.owner_id for event in events} | {row.profile_id for row in participants + invitations})
+    for start in range(0, len(members), LOOKUP_BATCH):
+        versions.touch(Profile, *members[start:start + LOOKUP_BATCH])
+    joined = sorted({participant.profile_id for participant in participants})
+    for start in range(0, len(joined), LOOKUP_BATCH):
+        recommendations.mark_stale(joined[start:start + LOOKUP_BATCH])
+
+    return {
+        "events": len(events),
+        "participants": len(participants),
+        "invitations": len(invitations),
+        "comments": len(comments),
+        "evaluations": len(evaluations)
+    }
+
+
+def import_records(records, chunk_size=CHUNK_SIZE, batch_size=None, dry_run=False):
+    """
+    Validates and writes (line number, raw record) pairs chunk by chunk,
+    each chunk in its own transaction, so memory use does not grow with the
+    file. Yields the number of valid records, the rows written per model and
+    the rejected lines of every chunk. Nothing is written with dry_run.
+    """
+    for chunk in chunks(records, chunk_size):
+        # With DEBUG every query is kept, a long import would hold thousands of huge INSERTs
+        reset_queries()
+        with transaction.atomic():
+            rows, errors = validate(chunk)
+            written = {} if dry_run else store(rows, batch_size)
+        yield len(rows), written, errors
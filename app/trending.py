@@ -0,0 +1,156 @@
+import math
+from collections import defaultdict
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest, Least, Log, Power
+from django.db.models.signals import m2m_changed, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Comment, Evaluation, Event, TrendingScore
+from .pagination import KeysetPage, KeysetPaginator
+
+# Scores are stored as log2 of the activity decayed to this fixed point in
+# time. Every score decays at the same rate, so their order is right at any
+# moment without rewriting rows, and the log keeps the numbers small
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+JOIN_WEIGHT = 1.0
+COMMENT_WEIGHT = 0.5
+# Multiplied by grade / 10
+RATE_WEIGHT = 2.0
+
+
+def half_life():
+    return getattr(settings, 'TRENDING_HALF_LIFE', 24 * 60 * 60)
+
+
+def decayed(weight, when):
+    return math.log2(weight) + (when - EPOCH).total_seconds() / half_life()
+
+
+def log_add(score, value):
+    # log2(2^score + 2^value) without leaving the log space
+    high, low = Greatest(score, value), Least(score, value)
+    return high + Log(2, 1 + Power(2, low - high))
+
+
+def record(event_id, weight, when=None):
+    """Adds activity of the given weight to the score of a public event."""
+    value = Value(decayed(weight, when or timezone.now()))
+    if TrendingScore.objects.filter(event_id=event_id).update(score=log_add(F('score'), value)):
+        return
+    if Event.objects.filter(pk=event_id, public_flag=True).exists():
+        # A concurrent first activity may win the insert, its weight is kept instead
+        TrendingScore.objects.bulk_create([TrendingScore(event_id=event_id, score=value.value)],
+                                          ignore_conflicts=True)
+
+
+def rebuild(batch_size=None):
+    """
+    Recomputes every score from the stored activity and returns the number
+    of ranked events. Participants have no join time, they are counted at
+    the event's start or now, whichever is earlier. Events whose activity
+    has decayed to nothing are dropped from the ranking.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        TrendingScore.objects.all().delete()
+        if connection.vendor == 'sqlite':
+            return rebuild_sqlite(now)
+        return rebuild_python(now, batch_size)
+
+
+def rebuild_sqlite(now):
+    # Aggregated and inserted by SQLite itself, no rows reach Python
+    tables = {
+        "score": TrendingScore._meta.db_table,
+        "event": Event._meta.db_table,
+        "comment": Comment._meta.db_table,
+        "evaluation": Evaluation._meta.db_table
+    }
+    decay = 'POWER(2, MIN(0, julianday(at) - julianday(%s)) * 86400 / %s)'
+    sql = (
+        'INSERT INTO {score} (event_id, score) '
+        'SELECT event_id, LOG(2, SUM(weight * {decay})) + %s FROM ('
+        'SELECT id AS event_id, participant_count * %s AS weight, start_time AS at FROM {event} '
+        'WHERE public_flag AND participant_count > 0 '
+        'UNION ALL SELECT c.event_id, %s, c.posted_on FROM {comment} c '
+        'INNER JOIN {event} e ON e.id = c.event_id WHERE e.public_flag '
+        'UNION ALL SELECT v.event_id, v.grade * %s / 10.0, e.end_time FROM {evaluation} v '
+        'INNER JOIN {event} e ON e.id = v.event_id WHERE e.public_flag'
+        ') activity GROUP BY event_id HAVING SUM(weight * {decay}) > 0'
+    ).format(decay=decay, **tables)
+    now_value = connection.ops.adapt_datetimefield_value(now)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [now_value, half_life(), (now - EPOCH).total_seconds() / half_life(),
+                             JOIN_WEIGHT, COMMENT_WEIGHT, RATE_WEIGHT, now_value, half_life()])
+        return cursor.rowcount
+
+
+def rebuild_python(now, batch_size):
+    totals = defaultdict(float)
+
+    def add(event_id, weight, when):
+        # Relative to now, the absolute values would overflow a float
+        totals[event_id] += weight * 2 ** (min(0.0, (when - now).total_seconds()) / half_life())
+
+    public = Event.objects.filter(public_flag=True)
+    for event_id, count, start_time in public.filter(participant_count__gt=0) \
+            .values_list('id', 'participant_count', 'start_time').iterator():
+        add(event_id, JOIN_WEIGHT * count, start_time)
+    for event_id, posted_on in Comment.objects.filter(event__public_flag=True) \
+            .values_list('event_id', 'posted_on').iterator():
+        add(event_id, COMMENT_WEIGHT, posted_on)
+    for event_id, grade, end_time in Evaluation.objects.filter(event__public_flag=True) \
+            .values_list('event_id', 'grade', 'event__end_time').iterator():
+        add(event_id, RATE_WEIGHT * grade / 10, end_time)
+
+    offset = (now - EPOCH).total_seconds() / half_life()
+    scores = [TrendingScore(event_id=event_id, score=math.log2(total) + offset)
+              for event_id, total in totals.items() if total > 0]
+    TrendingScore.objects.bulk_create(scores, batch_size=batch_size)
+    return len(scores)
+
+
+def page(cursor, per_page):
+    # Only public events are scored, filtering on the event here would make
+    # the database sort every score instead of reading the index
+    scores = KeysetPaginator(TrendingScore.objects.all(), per_page,
+                             ordering=('-score', '-event'), count_timeout=0).page(cursor)
+    event_ids = [score.event_id for score in scores]
+    events = Event.objects.for_listing().filter(public_flag=True).in_bulk(event_ids)
+    object_list = [events[event_id] for event_id in event_ids if event_id in events]
+    return KeysetPage(object_list, scores.next_cursor, scores.previous_cursor)
+
+
+@receiver(m2m_changed, sender=Event.participants.through)
+def record_joins(sender, instance, action, reverse, pk_set, **kwargs):
+    if action != 'post_add' or not pk_set:
+        return
+    if reverse:
+        for event_id in pk_set:
+            record(event_id, JOIN_WEIGHT)
+    else:
+        record(instance.pk, JOIN_WEIGHT * len(pk_set))
+
+
+@receiver(post_save, sender=Comment)
+def record_comment(sender, instance, created, **kwargs):
+    if created:
+        record(instance.event_id, COMMENT_WEIGHT)
+
+
+@receiver(post_save, sender=Evaluation)
+def record_evaluation(sender, instance, created, **kwargs):
+    if created:
+        record(instance.event_id, RATE_WEIGHT * instance.grade / 10)
+
+
+@receiver(post_save, sender=Event)
+def drop_private_event(sender, instance, **kwargs):
+    if not instance.public_flag:
+        TrendingScore.objects.filter(event=instance).delete()
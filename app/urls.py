@@ -1,10 +1,14 @@
 from django.urls import path, include
-from . import views
+from . import api, views
 
 app_name = 'app'
 urlpatterns = [
     path('', views.index, name='index'),
     path('private_events/', views.private_events, name='private_events'),
+    path('timeline/', views.home_timeline, name='timeline'),
+    path('trending/', views.trending_events, name='trending'),
+    path('calendar/', views.event_calendar, name='calendar'),
+    path('calendar/<str:token>/events.ics', views.calendar_feed, name='calendar_feed'),
     path('signup/', views.signup, name='signup'),
     path('accounts/', include('django.contrib.auth.urls')),
     path('event/<int:pk>/', views.event_detail, name='event_detail'),
@@ -13,9 +17,21 @@ urlpatterns = [
     path('user/edit/', views.edit_profile, name='edit_profile'),
     path('event/<int:pk>/participation/', views.participation, name='participation'),
     path('event/<int:pk>/comment/', views.comment, name='comment'),
+    path('event/<int:pk>/comments/', views.comments, name='comments'),
     path('event/<int:pk>/rate', views.rate_event, name='rate_event'),
     path('user/<int:pk>/follow/', views.follow_user, name='follow_user'),
     path('event/<int:event_id>/invite_users/', views.invite_users, name='invite_users'),
-    path('search/', views.search, name='search')
+    path('search/', views.search, name='search'),
+    path('cache/stats/', views.cache_stats, name='cache_stats'),
+    path('profiling/report/', views.profiling_report, name='profiling_report'),
+    path('api/events/', api.events, name='api_events'),
+    path('api/events/export/', api.export_events, name='api_export_events'),
+    path('api/events/<int:pk>/', api.event, name='api_event'),
+    path('api/events/<int:pk>/comments/', api.event_comments, name='api_event_comments'),
+    path('api/events/<int:pk>/evaluations/', api.event_evaluations, name='api_event_evaluations'),
+    path('api/calendar/', api.calendar, name='api_calendar'),
+    path('api/calendar/conflicts/', api.calendar_conflicts, name='api_calendar_conflicts'),
+    path('api/profiles/', api.profiles, name='api_profiles'),
+    path('api/profiles/<int:pk>/', api.profile, name='api_profile')
 ]
 
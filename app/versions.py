@@ -0,0 +1,121 @@
+import hashlib
+
+from django.contrib.auth.models import User
+from django.db.models import F, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.middleware.csrf import get_token
+from django.contrib import messages
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from .models import Profile, Event, Comment, Evaluation, SuggestedProfile
+
+
+def touch(model, *pks):
+    """Marks the given Event or Profile rows as changed."""
+    if pks:
+        touch_all(model.objects.filter(pk__in=pks))
+
+
+def touch_all(queryset):
+    # Versions key the cached fragments of app.caching as well as the ETags below
+    queryset.update(version=F('version') + 1, updated_at=timezone.now())
+
+
+class Validator:
+    """
+    ETag and Last-Modified of a page built from versioned objects, other
+    change times (modified) and whatever else about the request changes
+    the page (vary_on, the CSRF secret embedded in its forms).
+    """
+
+    def __init__(self, request, objects, vary_on=(), modified=()):
+        modified = [obj.updated_at for obj in objects] + [stamp for stamp in modified if stamp is not None]
+        parts = ['%s:%s:%s' % (obj._meta.label, obj.pk, obj.version) for obj in objects]
+        parts += [str(value) for value in list(vary_on) + modified]
+        # get_token() salts the secret differently on every call, the cookie itself is stable
+        get_token(request)
+        parts.append(request.META['CSRF_COOKIE'])
+        self.etag = '"%s"' % hashlib.md5('|'.join(parts).encode()).hexdigest()
+        self.last_modified = max(modified).timestamp()
+        # Pending flash messages are rendered into the page, it has to be sent again
+        self.has_messages = len(messages.get_messages(request)) > 0
+
+    def not_modified(self, request):
+        """Returns a 304 response when the client's copy is still current, otherwise None."""
+        if self.has_messages:
+            return None
+        response = get_conditional_response(request, etag=self.etag, last_modified=int(self.last_modified))
+        if response is not None:
+            self.apply(response)
+        return response
+
+    def apply(self, response):
+        response['ETag'] = self.etag
+        response['Last-Modified'] = http_date(self.last_modified)
+        # Browsers keep the page but ask whether it changed on every visit
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_save, sender=Profile)
+def touch_saved(sender, instance, created, **kwargs):
+    # Incremented in the database, a stale instance would count from an older version
+    if not created:
+        touch(sender, instance.pk)
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def touch_owner(sender, instance, **kwargs):
+    # The owner's page lists their hosted events
+    touch(Profile, instance.owner_id)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def touch_commented_event(sender, instance, **kwargs):
+    touch(Event, instance.event_id)
+
+
+@receiver(post_save, sender=Evaluation)
+@receiver(post_delete, sender=Evaluation)
+def touch_rated_event(sender, instance, **kwargs):
+    # The event page asks participants to rate, the host's page shows the rating
+    touch(Event, instance.event_id)
+    touch(Profile, *Event.objects.filter(pk=instance.event_id).values_list('owner_id', flat=True))
+
+
+@receiver(m2m_changed, sender=Event.participants.through)
+@receiver(m2m_changed, sender=Event.invited_users.through)
+def touch_event_members(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    instance_model, related_model = (Profile, Event) if reverse else (Event, Profile)
+    touch(instance_model, instance.pk)
+    touch(related_model, *(pk_set or ()))
+
+
+@receiver(m2m_changed, sender=Profile.following.through)
+def touch_following(sender, instance, action, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    touch(Profile, instance.pk, *(pk_set or ()))
+
+
+@receiver(pre_save, sender=User)
+def touch_renamed_user(sender, instance, update_fields=None, **kwargs):
+    # Usernames are shown on the pages and rows of related events and profiles
+    if instance.pk is None or (update_fields is not None and 'username' not in update_fields):
+        return
+    if User.objects.filter(pk=instance.pk, username=instance.username).exists():
+        return
+    participating = Event.participants.through.objects.filter(profile__user=instance).values('event_id')
+    commented = Comment.objects.filter(owner__user=instance).values('event_id')
+    touch_all(Event.objects.filter(Q(owner__user=instance) | Q(pk__in=participating) | Q(pk__in=commented)))
+    followers = Profile.following.through.objects.filter(to_profile__user=instance).values('from_profile_id')
+    suggested_to = SuggestedProfile.objects.filter(suggested__user=instance).values('profile_id')
+    touch_all(Profile.objects.filter(Q(pk__in=followers) | Q(pk__in=suggested_to)))
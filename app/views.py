@@ -1,103 +1,197 @@
-from django.shortcuts import render, redirect
+from datetime import datetime, timedelta
+
+from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.models import User
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.utils import timezone
-from django.http import Http404
-from django.core.paginator import Paginator
-from django.db.models import Q
+from django.utils.functional import SimpleLazyObject
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.models import Count, OuterRef, Subquery
 
+from . import api, caching, profiling, schedule, tasks, timeline, trending, versions
 from .forms import ProfileForm, UserForm, CreateEventForm, UserCreationForm, CommentForm, RateForm
-from .models import Event, Comment, Evaluation
+from .models import Profile, Event, Comment, Evaluation, SuggestedEvent
+from .pagination import KeysetPaginator
+from .search import get_backend as search_backend
 
 EVENTS_PER_PAGE = 2
+COMMENTS_PER_PAGE = 20
+SUGGESTIONS_SHOWN = 5
+# Larger invitation lists are handed to the task queue
+INVITE_SYNC_LIMIT = 50
 
 
 @login_required
 def index(request):
-    page = request.GET.get('page', default='1')
-    events = Event.objects.filter(public_flag=True).order_by('-start_time')
-    paginator = Paginator(events, EVENTS_PER_PAGE)
+    cursor = request.GET.get('cursor', '')
+    events = Event.objects.for_listing().filter(public_flag=True)
+    paginator = KeysetPaginator(events, EVENTS_PER_PAGE)
     context = {
-        "events_page": paginator.page(page)
+        "events_page": paginator.page(cursor)
     }
+    if request.user.is_authenticated and not cursor:
+        # Precomputed by app.recommendations, events that have ended since are skipped
+        context["suggested_events"] = SuggestedEvent.objects.filter(
+            profile=request.user.profile, event__end_time__gt=timezone.now()
+        ).select_related('event__owner__user').order_by('-score')[:SUGGESTIONS_SHOWN]
     return render(request, 'index.html', context)
 
 
 @login_required
 def private_events(request):
-    page = request.GET.get('page', default='1')
-    events = list(request.user.profile.events_invited_to.filter(public_flag=False))
-    events.extend(list(request.user.profile.hosted_events.filter(public_flag=False)))
-    events.sort(key=lambda event: event.start_time, reverse=True)
-    paginator = Paginator(events, EVENTS_PER_PAGE)
+    cursor = request.GET.get('cursor', '')
+    events = Event.objects.for_listing().private_for(request.user.profile)
+    paginator = KeysetPaginator(events, EVENTS_PER_PAGE)
     context = {
-        "events_page": paginator.page(page)
+        "events_page": paginator.page(cursor)
     }
     return render(request, 'index.html', context)
 
 
 @login_required
-def event_detail(request, pk):
-    event = Event.objects.get(pk=pk)
-    if not event:
-        raise Http404("Event not found!")
+def home_timeline(request):
+    cursor = request.GET.get('cursor', '')
+    context = {
+        "events_page": timeline.page(request.user.profile, cursor, EVENTS_PER_PAGE)
+    }
+    return render(request, 'index.html', context)
 
-    if event.public_flag is False and event not in request.user.profile.events_invited_to.all() and \
-            event not in request.user.profile.hosted_events.all():
-        return redirect('app:index')
 
-    users_to_invite = request.user.profile.following
-    for u in event.invited_users.all():
-        users_to_invite.remove(u)
+@login_required
+def trending_events(request):
+    cursor = request.GET.get('cursor', '')
+    context = {
+        "events_page": trending.page(cursor, EVENTS_PER_PAGE)
+    }
+    return render(request, 'index.html', context)
 
-    comment_form = CommentForm()
-    rate_form = RateForm()
-    should_rate = True
-    if timezone.now() < event.end_time or event.owner == request.user.profile or request.user.profile not in event.participants.all():
-        should_rate = False
 
-    evaluated = Evaluation.objects.filter(grader=request.user.profile).filter(event=event).first()
-    if evaluated:
-        should_rate = False
+@login_required
+def event_calendar(request):
+    try:
+        first_day = datetime.strptime(request.GET.get('start', ''), '%Y-%m-%d').date()
+    except ValueError:
+        first_day = timezone.localdate()
+    try:
+        count = max(1, min(int(request.GET.get('days', 7)), schedule.CALENDAR_MAX_DAYS))
+    except ValueError:
+        count = 7
+    mine = request.GET.get('scope') == 'mine'
+
+    profile = request.user.profile
+    events = schedule.attended_by(profile) if mine else schedule.visible_to(profile)
+    start, end = schedule.local_range(first_day, count)
+    events = list(schedule.overlapping(events, start, end, by_day=not mine).select_related('owner__user')
+                  .order_by('start_time', 'id'))
+
+    days = []
+    for offset in range(count):
+        day_start, day_end = schedule.local_range(first_day + timedelta(days=offset), 1)
+        days.append((day_start, [event for event in events
+                                 if event.start_time < day_end and event.end_time > day_start]))
+
+    context = {
+        "days": days,
+        "mine": mine,
+        "conflicts": schedule.conflicts(events) if mine else [],
+        "previous_start": first_day - timedelta(days=count),
+        "next_start": first_day + timedelta(days=count),
+        "count": count,
+        "feed_token": schedule.feed_token(request.user)
+    }
+    return render(request, 'calendar.html', context)
+
+
+def calendar_feed(request, token):
+    """
+    iCalendar feed of the events a user hosts or takes part in. Calendar
+    apps cannot log in, the signed token in the URL identifies the user.
+    """
+    profile = get_object_or_404(Profile.objects.only('id'), user_id=schedule.feed_user_id(token))
+
+    now = timezone.now()
+    start, end = now - timedelta(days=schedule.FEED_PAST_DAYS), now + timedelta(days=schedule.FEED_FUTURE_DAYS)
+    rows = schedule.overlapping(schedule.attended_by(profile), start, end, by_day=False).order_by('start_time', 'id') \
+        .values_list('id', 'title', 'description', 'start_time', 'end_time')
+    response = StreamingHttpResponse(schedule.ical_feed(rows.iterator(), request),
+                                     content_type='text/calendar; charset=utf-8')
+    response['Content-Disposition'] = 'inline; filename="recreatus.ics"'
+    return response
+
+
+@login_required
+def event_detail(request, pk):
+    profile = request.user.profile
+    event = get_object_or_404(Event.objects.select_related('owner__user').with_viewer_state(profile), pk=pk)
+
+    is_host = event.owner_id == profile.id
+    if event.public_flag is False and not event.is_invited and not is_host:
+        return redirect('app:index')
 
     event_ended = timezone.now() > event.end_time
+    validator = versions.Validator(request, [event, event.owner, profile], vary_on=[
+        is_host, event.is_invited, event.is_participant, event.has_rated, event_ended])
+    not_modified = validator.not_modified(request)
+    if not_modified is not None:
+        return not_modified
+
+    # Only evaluated when the cached fragments showing them have expired
+    participants = event.participants.select_related('user')
+    comments_page = SimpleLazyObject(lambda: comment_page(event, ''))
+    users_to_invite = profile.following.select_related('user').exclude(
+        pk__in=Event.invited_users.through.objects.filter(event=event).values('profile_id'))
+
+    should_rate = event_ended and not is_host and event.is_participant and not event.has_rated
 
     context = {
         "event": event,
-        "comment_form": comment_form,
+        "is_host": is_host,
+        "participants": participants,
+        "comments_page": comments_page,
+        "comment_form": CommentForm(),
         "should_rate": should_rate,
-        "rate_form": rate_form,
+        "rate_form": RateForm(),
         "users_to_invite": users_to_invite,
         "event_ended": event_ended
     }
-    return render(request, 'event_detail.html', context)
+    return validator.apply(render(request, 'event_detail.html', context))
 
 
 @login_required
 def user_detail(request, pk):
-    user = User.objects.get(pk=pk)
-    if not user:
-        raise Http404("User not found!")
-
-    evaluations = Evaluation.objects.filter(event__owner=user.profile)
-    count = 0
-    rating = 0
-    for e in evaluations:
-        rating += e.grade
-        count += 1
-
-    if count > 0:
-        rating = rating / count
-    else:
+    # The latest change to the listed events comes with the user, so the
+    # version check is this one query
+    hosted = Event.objects.filter(owner=OuterRef('profile')).order_by('-updated_at').values('updated_at')[:1]
+    participating = Event.objects.filter(participants=OuterRef('profile')).order_by('-updated_at') \
+        .values('updated_at')[:1]
+    user = get_object_or_404(User.objects.select_related('profile').annotate(
+        hosted_updated_at=Subquery(hosted), participating_updated_at=Subquery(participating)), pk=pk)
+
+    validator = versions.Validator(request, [user.profile], vary_on=[request.user.pk],
+                                   modified=[user.hosted_updated_at, user.participating_updated_at])
+    not_modified = validator.not_modified(request)
+    if not_modified is not None:
+        return not_modified
+
+    rating = user.profile.rating
+    if rating is None:
         rating = "No rating to display"
     context = {
         "rating": rating,
-        "user": user
+        "user": user,
+        "is_following": request.user.profile.following.filter(pk=user.profile.pk).exists(),
+        "following": user.profile.following.select_related('user'),
+        "hosted_events": Event.objects.for_listing().filter(owner=user.profile).order_by('-start_time'),
+        "participating_events": Event.objects.for_listing().filter(participants=user.profile).order_by('-start_time')
     }
-    return render(request, 'user_detail.html', context)
+    if request.user == user:
+        context["suggested_profiles"] = user.profile.suggested_profiles.select_related('suggested__user') \
+            .order_by('-score')[:SUGGESTIONS_SHOWN]
+    return validator.apply(render(request, 'user_detail.html', context))
 
 
 @login_required
@@ -111,8 +205,10 @@ def create_event(request):
             end_time = create_event_form.cleaned_data['end_time']
             public_flag = create_event_form.cleaned_data['public_flag']
             owner = request.user.profile
-            new_event = Event.objects.create(title=title, description=description, start_time=start_time,
-                                             end_time=end_time, public_flag=public_flag, owner=owner)
+            with transaction.atomic():
+                new_event = Event.objects.create(title=title, description=description, start_time=start_time,
+                                                 end_time=end_time, public_flag=public_flag, owner=owner)
+                tasks.enqueue(tasks.fan_out_event, new_event.id, idempotency_key='fan-out:event:%d' % new_event.id)
             messages.success(request, 'Event created successfully')
             return redirect('app:event_detail', new_event.id)
         else:
@@ -154,7 +250,7 @@ def signup(request):
         user_form = UserCreationForm(request.POST)
         if user_form.is_valid():
             user = user_form.save()
-            login(request, user)
+            login(request, user, backend='app.backends.auth.ProfileBackend')
             messages.success(request, 'You have successfully signed up')
             return redirect('app:index')
         messages.error(request, 'Failed to sign up.')
@@ -185,6 +281,33 @@ def comment(request, pk):
     return redirect('app:event_detail', event.id)
 
 
+def comment_page(event, cursor):
+    # Newest first, the commenter comes from the same query
+    comments = event.comments.select_related('owner__user')
+    return KeysetPaginator(comments, COMMENTS_PER_PAGE, ordering=('-posted_on', '-id'), count_timeout=0).page(cursor)
+
+
+@login_required
+def comments(request, pk):
+    """
+    Older comments of an event for the "load more" link of event_detail.
+    With ?format=json the same page comes from the API, cursors are shared.
+    """
+    if request.GET.get('format') == 'json':
+        return api.event_comments(request, pk)
+
+    profile = request.user.profile
+    event = get_object_or_404(Event.objects.with_viewer_state(profile).only('id', 'public_flag', 'owner_id'), pk=pk)
+    if event.public_flag is False and not event.is_invited and event.owner_id != profile.id:
+        raise Http404("Event not found!")
+
+    context = {
+        "event": event,
+        "comments_page": comment_page(event, request.GET.get('cursor', ''))
+    }
+    return render(request, '_comments.html', context)
+
+
 @login_required
 def rate_event(request, pk):
     event = Event.objects.get(pk=pk)
@@ -205,7 +328,12 @@ def rate_event(request, pk):
         if rate_form.is_valid():
             grade = rate_form.cleaned_data['grade']
             grader = request.user.profile
-            Evaluation.objects.create(grade=grade, grader=grader, event=event)
+            try:
+                with transaction.atomic():
+                    Evaluation.objects.create(grade=grade, grader=grader, event=event)
+            except IntegrityError:
+                messages.error(request, 'You have already rated this event')
+                return redirect('app:event_detail', event.id)
             messages.success(request, 'You have successfully rated the event')
         else:
             messages.error(request, 'Failed to rate event')
@@ -248,11 +376,15 @@ def follow_user(request, pk):
     following = request.GET.get('follow', '')
     if following == 'true':
         if user.profile not in request.user.profile.following.all():
-            request.user.profile.following.add(user.profile)
+            with transaction.atomic():
+                request.user.profile.following.add(user.profile)
+                tasks.enqueue(tasks.update_follow_timelines, request.user.profile.id, user.profile.id)
             messages.success(request, 'User followed')
     elif following == 'false':
         if user.profile in request.user.profile.following.all():
-            request.user.profile.following.remove(user.profile)
+            with transaction.atomic():
+                request.user.profile.following.remove(user.profile)
+                tasks.enqueue(tasks.update_follow_timelines, request.user.profile.id, user.profile.id)
             messages.success(request, 'You no longer follow this user')
     else:
         return redirect('app:index')
@@ -266,12 +398,14 @@ def invite_users(request, event_id):
         raise Http404("Event not found!")
 
     if request.method == 'POST':
-        invited_users_ids = request.POST.getlist('invited_users')
-        for user_id in invited_users_ids:
-            user = User.objects.get(pk=user_id)
-            if user and user.profile not in event.invited_users.all():
-                event.invited_users.add(user.profile)
-        messages.success(request, 'Users invited')
+        user_ids = request.POST.getlist('invited_users')
+        if len(user_ids) > INVITE_SYNC_LIMIT:
+            tasks.enqueue(tasks.invite_users, event.id, user_ids)
+            messages.success(request, 'Invitations to %d users are being sent' % len(user_ids))
+        else:
+            with transaction.atomic():
+                invited, skipped = event.invite(user_ids)
+            messages.success(request, '%d users invited, %d skipped' % (invited, skipped))
     return redirect('app:event_detail', event_id)
 
 
@@ -279,28 +413,28 @@ def invite_users(request, event_id):
 def search(request):
     query = request.GET.get('query', '')
     type = request.GET.get('type', '')
-    page = request.GET.get('page', default='1')
+    cursor = request.GET.get('cursor', '')
     if query == '' or type == '':
         return redirect('app:index')
 
     if type == 'events':
-        events = Event.objects.filter(public_flag=True).filter(Q(title__icontains=query) | Q(description__icontains=query)).order_by('-start_time')
-        paginator = Paginator(events, EVENTS_PER_PAGE)
+        events = Event.objects.for_listing().filter(public_flag=True)
         url_params = "query=" + query.replace(' ', "+", -1)
         url_params += "&type=events"
         context = {
-            "page": paginator.page(page),
+            "page": search_backend().search_events(events, query, cursor, EVENTS_PER_PAGE),
             "type": "events",
             "url_params": url_params
         }
         return render(request, 'search.html', context)
     elif type == 'users':
-        users = User.objects.filter(Q(username__icontains=query))
-        paginator = Paginator(users, EVENTS_PER_PAGE)
+        users = User.objects.select_related('profile').annotate(
+            hosted_count=Count('profile__hosted_events', distinct=True),
+            participating_count=Count('profile__events_participating', distinct=True))
         url_params = "query=" + query.replace(' ', "+", -1)
         url_params += "&type=users"
         context = {
-            "page": paginator.page(page),
+            "page": search_backend().search_users(users, query, cursor, EVENTS_PER_PAGE),
             "type": "users",
             "url_params": url_params
         }
@@ -309,3 +443,14 @@ def search(request):
         print("nista")
         return redirect('app:index')
 
+
+@staff_member_required
+def cache_stats(request):
+    return JsonResponse(caching.stats())
+
+
+@staff_member_required
+def profiling_report(request):
+    if request.method == 'POST':
+        profiling.recorder.reset()
+    return JsonResponse(profiling.recorder.report())